@@ -0,0 +1,119 @@
+"""
+A-XDR walker for han_kamstrup.
+
+Walks the DLMS/COSEM data-notification in a HAN frame and returns where
+each element is, so values can be mapped by their OBIS code instead of
+by fixed offsets. The frame layout is:
+
+    8   LLC bytes and data-notification tag (DATA_FLAG)
+    12  long-invoke-id-and-priority, 4 bytes
+    16  date-time, octet-string with length byte and no tag
+        notification body, A-XDR data starting with a structure
+"""
+
+from typing import NamedTuple
+
+NULL = 0x00
+STRUCTURE = 0x02
+DOUBLE_LONG = 0x05
+DOUBLE_LONG_UNSIGNED = 0x06
+OCTET_STRING = 0x09
+VISIBLE_STRING = 0x0A
+INTEGER = 0x0F
+LONG = 0x10
+UNSIGNED = 0x11
+LONG_UNSIGNED = 0x12
+ENUM = 0x16
+
+FIXED_SIZES = {
+    NULL: 0,
+    DOUBLE_LONG: 4,
+    DOUBLE_LONG_UNSIGNED: 4,
+    INTEGER: 1,
+    LONG: 2,
+    UNSIGNED: 1,
+    LONG_UNSIGNED: 2,
+    ENUM: 1,
+}
+
+STRINGS = frozenset((OCTET_STRING, VISIBLE_STRING))
+
+DATA_FLAG = b'\xe6\xe7\x00\x0f'
+NOTIFICATION_OFFSET = 8
+DATE_TIME_OFFSET = 16
+
+
+class Element(NamedTuple):
+    """A data element in a frame."""
+
+    # pylint: disable=too-few-public-methods
+    tag: int
+    offset: int
+    value_offset: int
+    size: int
+
+
+class Notification(NamedTuple):
+    """The parts of a data-notification."""
+
+    # pylint: disable=too-few-public-methods
+    date_time: Element
+    body: Element
+    elements: tuple
+
+
+def _element(data, offset, end):
+    """Return the element at offset."""
+    if offset >= end:
+        raise ValueError('Element at %s past end of data' % offset)
+    tag = data[offset]
+    if tag in FIXED_SIZES:
+        element = Element(tag, offset, offset + 1, FIXED_SIZES[tag])
+    elif tag in STRINGS or tag == STRUCTURE:
+        if offset + 1 >= end:
+            raise ValueError('Length at %s past end of data' % (offset + 1))
+        element = Element(tag, offset, offset + 2, data[offset + 1])
+    else:
+        raise ValueError('Unknown tag %#x at %s' % (tag, offset))
+    if tag != STRUCTURE and element.value_offset + element.size > end:
+        raise ValueError('Element at %s past end of data' % offset)
+    return element
+
+
+def walk(data, offset, end=None):
+    """Return the element at offset and the elements nested in it.
+
+    The elements of a structure follow it in the returned list, in
+    order. Lengths above 127 (multi-byte lengths) are not used in HAN
+    frames and are not supported.
+    """
+    if end is None:
+        end = len(data)
+    elements = []
+    pending = 1
+    while pending:
+        element = _element(data, offset, end)
+        elements.append(element)
+        pending -= 1
+        if element.tag == STRUCTURE:
+            pending += element.size
+            offset = element.value_offset
+        else:
+            offset = element.value_offset + element.size
+    return elements
+
+
+def notification(data, end=None):
+    """Walk the data-notification of a frame.
+
+    end defaults to the start of the frame check sequence.
+    """
+    if end is None:
+        end = len(data) - 3
+    if bytes(data[NOTIFICATION_OFFSET:DATE_TIME_OFFSET - 4]) != DATA_FLAG:
+        raise ValueError('Not a data-notification')
+    size = data[DATE_TIME_OFFSET]
+    date_time = Element(OCTET_STRING, DATE_TIME_OFFSET,
+                        DATE_TIME_OFFSET + 1, size)
+    elements = walk(data, date_time.value_offset + size, end)
+    return Notification(date_time, elements[0], tuple(elements[1:]))
@@ -0,0 +1,127 @@
+"""
+Benchmark for the han_kamstrup decode path.
+
+Frames of every list type are made with han_synth, and each stage of the
+path is timed on its own: framing a byte stream, the CRC, test_valid_data,
+decode_frame (parse_data without the JSON step), JSON serialization and
+the han_sinks encoders. Each stage reports frames per second over the
+whole batch and the per-frame latency of single calls. The original
+parse_data of han_legacy is timed next to the current one, and the
+speedup is printed.
+
+    python han_bench.py [--frames N] [--list-type 17|27|25|35] [--seed N]
+"""
+
+import argparse
+import json
+import random
+from time import perf_counter
+import han_crc
+import han_decode
+import han_frame
+import han_kamstrup
+import han_legacy
+import han_sinks
+import han_synth
+
+try:
+    from crccheck.crc import CrcX25
+except ImportError:
+    CrcX25 = None
+
+FRAMES = 5000
+
+
+def _percentile(ordered, fraction):
+    """Return the value at fraction of an ordered list."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench(name, func, items):
+    """Time func over items and print throughput and per-frame latency.
+
+    Returns the mean seconds per item.
+    """
+    started = perf_counter()
+    for item in items:
+        func(item)
+    elapsed = perf_counter() - started
+
+    latencies = []
+    for item in items:
+        call_started = perf_counter()
+        func(item)
+        latencies.append(perf_counter() - call_started)
+    latencies.sort()
+    print('%-18s %10.0f frames/s %8.2f us mean %8.2f us p50 %8.2f us p99'
+          % (name, len(items) / elapsed, elapsed / len(items) * 1e6,
+             _percentile(latencies, 0.5) * 1e6,
+             _percentile(latencies, 0.99) * 1e6))
+    return elapsed / len(items)
+
+
+def bench_framing(name, data, count, chunk_size=han_kamstrup.READ_SIZE):
+    """Time splitting a byte stream of count frames into frames."""
+    chunks = [data[pos:pos + chunk_size]
+              for pos in range(0, len(data), chunk_size)]
+    framer = han_frame.HdlcFramer()
+    found = 0
+    started = perf_counter()
+    for chunk in chunks:
+        framer.feed(chunk)
+        for _ in framer:
+            found += 1
+    elapsed = perf_counter() - started
+    if found != count:
+        raise RuntimeError('Framer found %s of %s frames' % (found, count))
+    print('%-18s %10.0f frames/s %8.2f us mean'
+          % (name, count / elapsed, elapsed / count * 1e6))
+
+
+def run(list_types, count, seed):
+    """Run the benchmarks for each list type."""
+    rng = random.Random(seed)
+    for list_type in list_types:
+        frames = [han_synth.random_frame(list_type, rng)
+                  for _ in range(count)]
+        decoded = [han_decode.decode_frame(frame) for frame in frames]
+        readings = [reading.as_dict() for reading in decoded]
+        print('list type %s, %s frames of %s bytes'
+              % (list_type, count, len(frames[0])))
+        bench_framing('framing', han_synth.stream(frames), count)
+        bench('crc_x25', lambda frame: han_crc.crc_x25(frame[1:-3]), frames)
+        if CrcX25 is not None:
+            bench('crccheck CrcX25',
+                  lambda frame: CrcX25.calc(frame[1:-3]), frames[:500])
+        bench('test_valid_data', han_kamstrup.check_frame, frames)
+        bench('decode_frame', han_decode.decode_frame, frames)
+        bench('json', json.dumps, readings)
+        for name, encoder in han_sinks.ENCODERS.items():
+            bench('sink ' + name, encoder, decoded)
+        legacy = bench('legacy parse_data',
+                       lambda frame: han_legacy.parse_data({}, frame), frames)
+        current = bench('parse_data+json',
+                        lambda frame: han_decode.parse_data({}, frame), frames)
+        print('%-18s %10.1fx' % ('speedup', legacy / current))
+        stored = {}
+        bench('parse_data delta',
+              lambda frame: han_decode.parse_data(stored, frame, True),
+              frames)
+        print()
+
+
+def main(argv=None):
+    """Parse arguments and run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=FRAMES,
+                        help='frames per list type')
+    parser.add_argument('--list-type', type=int, action='append',
+                        choices=han_synth.LIST_TYPES,
+                        help='list type to run, default all')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    run(args.list_type or han_synth.LIST_TYPES, args.frames, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+Columnar bulk decoder for han_kamstrup.
+
+Frames of a list type from one meter have the same size and layout, so
+a batch of them stacked in one buffer is decoded at once with a NumPy
+structured dtype built from the han_decode fields of the first frame.
+Frames are grouped by their han_decode layout, so frames of another
+size or field order are decoded in a group of their own. Measurements
+come out as one array per field instead of one dict per frame.
+
+NumPy is only needed for this module.
+
+    python han_bulk.py capture.han output.csv|output.npz
+"""
+
+import argparse
+import csv
+import heapq
+import logging
+import sys
+import han_capture
+import han_decode
+import han_kamstrup
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# kind: dtype of the raw field, for the kinds that hold a measurement.
+_NUMERIC_KINDS = {
+    'uint8': 'u1',
+    'int8': 'i1',
+    'uint16': '>u2',
+    'int16': '>i2',
+    'uint32': '>u4',
+    'int32': '>i4',
+    'hundredths': '>u4',
+    'signed_hundredths': '>i4',
+}
+
+_SCALED_KINDS = frozenset(('hundredths', 'signed_hundredths'))
+
+# Parts of a COSEM date-time: (name, offset in field, dtype).
+_DATE_TIME_PARTS = (
+    ('year', 0, '>u2'),
+    ('month', 2, 'u1'),
+    ('day', 3, 'u1'),
+    ('hour', 5, 'u1'),
+    ('minute', 6, 'u1'),
+    ('second', 7, 'u1'),
+)
+
+
+def _require_numpy():
+    """Raise if NumPy is not installed."""
+    if np is None:
+        raise ImportError('han_bulk needs numpy: pip install numpy')
+
+
+def frame_dtype(fields, frame_size):
+    """Return a structured dtype reading fields of a frame in place.
+
+    fields are as returned by han_decode.frame_fields().
+
+    Date-time fields are split into their parts, named date_time.year and
+    so on. OBIS codes and strings are left out, except meter_serial.
+    """
+    _require_numpy()
+    names, formats, offsets = [], [], []
+
+    def add(name, fmt, offset):
+        names.append(name)
+        formats.append(fmt)
+        offsets.append(offset)
+
+    for field, offset, kind, size in fields:
+        if kind in _NUMERIC_KINDS:
+            add(field, _NUMERIC_KINDS[kind], offset)
+        elif kind == 'date_time':
+            for part, part_offset, fmt in _DATE_TIME_PARTS:
+                add('%s.%s' % (field[0], part), fmt, offset + part_offset)
+        elif kind == 'meter_serial':
+            add(field, 'S%d' % size, offset)
+    return np.dtype({'names': names, 'formats': formats,
+                     'offsets': offsets, 'itemsize': frame_size})
+
+
+def _datetimes(raw, field):
+    """Combine the parts of a date-time field into datetime64[s]."""
+    part = {name: raw['%s.%s' % (field, name)].astype(np.int64)
+            for name, _, _ in _DATE_TIME_PARTS}
+    months = (part['year'] - 1970) * 12 + part['month'] - 1
+    days = months.astype('M8[M]').astype('M8[D]') + (part['day'] - 1)
+    seconds = part['hour'] * 3600 + part['minute'] * 60 + part['second']
+    return days.astype('M8[s]') + seconds.astype('m8[s]')
+
+
+def decode_columns(frames):
+    """Decode a batch of validated frames of one layout.
+
+    frames is a 2D uint8 array with one frame per row, or a bytes-like
+    object of frames of equal size back to back. The layout is walked
+    from the first frame. Raises ValueError if it can not be walked.
+    Returns a dict of arrays
+    keyed by the han_decode field names. Date-times are datetime64[s] in
+    the meter's local time, scaled measurements are float64.
+    """
+    _require_numpy()
+    if isinstance(frames, np.ndarray):
+        frame_size = frames.shape[-1]
+        buffer = np.ascontiguousarray(frames, dtype=np.uint8)
+    else:
+        buffer = np.frombuffer(frames, dtype=np.uint8)
+        frame_size = (int(buffer[1]) & 0x0F) << 8 | int(buffer[2])
+        frame_size += 2
+    buffer = buffer.reshape(-1)
+    fields, _ = han_decode.frame_fields(buffer[:frame_size].tobytes())
+    raw = buffer.view(frame_dtype(fields, frame_size))
+
+    columns = {}
+    for field, _, kind, size in fields:
+        if kind == 'date_time':
+            columns[field[0]] = _datetimes(raw, field[0])
+        elif kind in _SCALED_KINDS:
+            columns[field] = raw[field] / 100
+        elif kind in _NUMERIC_KINDS:
+            columns[field] = raw[field].astype(np.int64)
+        elif kind == 'meter_serial':
+            columns[field] = raw[field].astype('U%d' % size)
+    return columns
+
+
+class _Groups():
+    """Frames grouped by layout, with the receive time and source of each.
+
+    Groups are named by list type, and the further layouts of a list type
+    as '<list type>.<n>'. Frames that can not be walked are counted in
+    skipped.
+    """
+
+    def __init__(self):
+        """Initialize variables."""
+        self.groups = {}
+        self.names = {}
+        self.skipped = 0
+
+    def add(self, frame, timestamp=None, source=None):
+        """Add a frame to the group of its layout."""
+        try:
+            key = han_decode.layout_key(frame)
+        except ValueError as err:
+            _LOGGER.debug('Skipping frame: %s', err)
+            self.skipped += 1
+            return
+        group = self.groups.get(key)
+        if group is None:
+            list_type = frame[30]
+            count = self.names.get(list_type, 0)
+            self.names[list_type] = count + 1
+            name = ('%d' % list_type if not count
+                    else '%d.%d' % (list_type, count))
+            group = self.groups[key] = (name, [], [], [])
+        group[1].append(bytes(frame))
+        group[2].append(timestamp)
+        group[3].append(source)
+
+    def __iter__(self):
+        """Iterate over (name, frames, receive times, sources)."""
+        if self.skipped:
+            _LOGGER.warning('Skipped %s frames that could not be walked',
+                            self.skipped)
+        return iter(self.groups.values())
+
+
+def stack_frames(frames):
+    """Group validated frames by layout into 2D uint8 arrays.
+
+    Returns the arrays by group name: the list type, or
+    '<list type>.<n>' for further layouts of a list type.
+    """
+    _require_numpy()
+    groups = _Groups()
+    for frame in frames:
+        groups.add(frame)
+    return {name: _stack(group) for name, group, _, _ in groups}
+
+
+def _stack(frames):
+    """Stack frames of equal size into a 2D uint8 array."""
+    return np.frombuffer(b''.join(frames),
+                         dtype=np.uint8).reshape(len(frames), -1)
+
+
+def decode_capture(path):
+    """Decode every valid frame of a capture file.
+
+    Returns a dict of columns per layout, named as by stack_frames(),
+    with the receive time and source id of each frame added as
+    received_at and source.
+    """
+    _require_numpy()
+    groups = _Groups()
+    with han_capture.CaptureReader(path) as reader:
+        for timestamp, source, frame in reader:
+            if han_kamstrup.check_frame(frame) is not None:
+                continue
+            groups.add(frame, timestamp, source)
+    result = {}
+    for name, frames, received, sources in groups:
+        columns = decode_columns(_stack(frames))
+        columns['received_at'] = np.array(received)
+        columns['source'] = np.array(sources, dtype=np.uint16)
+        result[name] = columns
+    return result
+
+
+def _rows(columns):
+    """Iterate over the rows of columns as dicts."""
+    names = list(columns)
+    for row in zip(*(columns[name].tolist() for name in names)):
+        yield dict(zip(names, row))
+
+
+def write_csv(tables, output):
+    """Write tables of columns as one CSV to a text file object.
+
+    The rows of all tables are merged in received_at order if every table
+    has it. Columns missing from a table are left empty.
+    """
+    names = []
+    for columns in tables:
+        names.extend(name for name in columns if name not in names)
+    writer = csv.DictWriter(output, names)
+    writer.writeheader()
+    if all('received_at' in columns for columns in tables):
+        rows = heapq.merge(*(_rows(columns) for columns in tables),
+                           key=lambda row: row['received_at'])
+    else:
+        rows = (row for columns in tables for row in _rows(columns))
+    writer.writerows(rows)
+
+
+def write_npz(tables, path):
+    """Write tables of columns to a compressed .npz file.
+
+    Each column is stored as a '<group name>/<field>' array.
+    """
+    _require_numpy()
+    np.savez_compressed(path, **{
+        '%s/%s' % (list_type, name): column
+        for list_type, columns in tables.items()
+        for name, column in columns.items()})
+
+
+def main(argv=None):
+    """Decode a capture file to CSV or .npz."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('capture')
+    parser.add_argument('output', help='.csv or .npz file, - for stdout')
+    args = parser.parse_args(argv)
+    result = decode_capture(args.capture)
+    if args.output.endswith('.npz'):
+        write_npz(result, args.output)
+    elif args.output == '-':
+        write_csv(list(result.values()), sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            write_csv(list(result.values()), output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
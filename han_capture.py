@@ -0,0 +1,256 @@
+"""
+Raw frame capture files for han_kamstrup.
+
+A capture is an append-only file of raw frames as read from the meters,
+so decoding can be reproduced and benchmarked without hardware. The file
+starts with MAGIC, followed by one record per frame:
+
+    timestamp   float64  receive time, seconds since the epoch
+    source      uint16   id of the port the frame was read from
+    length      uint16   number of frame bytes
+    frame       length bytes
+
+All fields are little endian. A record cut short at the end of the file,
+from a writer that was stopped, is ignored by the reader.
+
+    python han_capture.py record capture.han /dev/ttyUSB0 /dev/ttyUSB1
+    python han_capture.py replay capture.han [--realtime] [--quiet]
+"""
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+from time import perf_counter, sleep, time
+import han_decode
+import han_kamstrup
+import han_multi
+
+MAGIC = b'HANCAP\x00\x01'
+RECORD = struct.Struct('<dHH')
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class CaptureWriter():
+    """Append frames to a capture file."""
+
+    def __init__(self, path):
+        """Open the capture file, writing the header if it is new."""
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, frame, source=0, timestamp=None):
+        """Append one frame."""
+        if timestamp is None:
+            timestamp = time()
+        self.file.write(RECORD.pack(timestamp, source, len(frame)))
+        self.file.write(frame)
+
+    def flush(self):
+        """Flush written frames to the file."""
+        self.file.flush()
+
+    def close(self):
+        """Close the capture file."""
+        self.file.close()
+
+    def __enter__(self):
+        """Return self for use as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the capture file."""
+        self.close()
+
+
+class CaptureReader():
+    """Read frames from a memory-mapped capture file.
+
+    Iterating gives (timestamp, source, frame) tuples where frame is a
+    memoryview into the mapped file, so frames are not copied. The file
+    stays mapped until the reader is closed and no frame is referenced.
+    """
+
+    def __init__(self, path):
+        """Map the capture file."""
+        with open(path, 'rb') as capture:
+            size = os.fstat(capture.fileno()).st_size
+            if size <= len(MAGIC):
+                self._map = None
+                self._view = memoryview(b'')
+            else:
+                self._map = mmap.mmap(capture.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+        if self._view and self._view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a capture file' % path)
+
+    def __iter__(self):
+        """Iterate over the records in the file."""
+        return self.records()
+
+    def records(self, start=None, stop=None):
+        """Iterate over the records from offset start up to offset stop."""
+        view = self._view
+        unpack_from = RECORD.unpack_from
+        header_size = RECORD.size
+        offset = len(MAGIC) if start is None else start
+        end = len(view) if stop is None else min(stop, len(view))
+        while offset + header_size <= end:
+            timestamp, source, length = unpack_from(view, offset)
+            offset += header_size
+            if offset + length > end:
+                break
+            yield timestamp, source, view[offset:offset + length]
+            offset += length
+
+    def offsets(self, start=None, stop=None):
+        """Iterate over the offsets of the records from start up to stop.
+
+        Only the record headers are read. The offset after the last
+        complete record comes last.
+        """
+        view = self._view
+        unpack_from = RECORD.unpack_from
+        header_size = RECORD.size
+        offset = len(MAGIC) if start is None else start
+        end = len(view) if stop is None else min(stop, len(view))
+        while offset + header_size <= end:
+            following = offset + header_size + unpack_from(view, offset)[2]
+            if following > end:
+                break
+            yield offset
+            offset = following
+        yield offset
+
+    def chunks(self, size):
+        """Return (start, stop) offsets cutting the records into chunks.
+
+        Chunks start at a record and hold about size bytes, so each can
+        be read with records(start, stop) on its own.
+        """
+        starts = []
+        cut = 0
+        for end in self.offsets():
+            if end >= cut:
+                starts.append(end)
+                cut = end + size
+        # The last offset is the end of the records, not a record.
+        if starts[-1] == end:
+            starts.pop()
+        return list(zip(starts, starts[1:] + [end]))
+
+    def close(self):
+        """Unmap the capture file."""
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Frames are still referenced, the map is closed with them.
+                pass
+            self._map = None
+
+    def __enter__(self):
+        """Return self for use as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Unmap the capture file."""
+        self.close()
+
+
+def replay(reader, realtime=False):
+    """Iterate over the records of a reader.
+
+    With realtime, the records are paced by their timestamps. Otherwise
+    they are replayed as fast as possible.
+    """
+    if not realtime:
+        yield from reader
+        return
+    offset = None
+    for entry in reader:
+        if offset is None:
+            offset = time() - entry[0]
+        delay = entry[0] + offset - time()
+        if delay > 0:
+            sleep(delay)
+        yield entry
+
+
+def record(path, ports):
+    """Capture raw frames from ports until interrupted."""
+    reader = han_multi.MultiMeterReader()
+    source_ids = {}
+    for source_id, port in enumerate(ports):
+        reader.add_port(port)
+        source_ids[port] = source_id
+        print('Recording %s as source %s' % (port, source_id),
+              file=sys.stderr)
+    with CaptureWriter(path) as writer:
+        try:
+            for meter, frame in reader.frames(validate=False):
+                writer.write(frame, source_ids[meter.source])
+                writer.flush()
+        except KeyboardInterrupt:
+            _LOGGER.error("Killed process on user signal")
+        finally:
+            reader.close()
+
+
+def run_replay(path, realtime=False, quiet=False):
+    """Validate and decode every frame of a capture."""
+    han_data = {}
+    frames = invalid = 0
+    started = perf_counter()
+    with CaptureReader(path) as reader:
+        for _, source, frame in replay(reader, realtime):
+            frames += 1
+            if han_kamstrup.check_frame(frame) is not None:
+                invalid += 1
+                continue
+            stored = han_data.setdefault(source, {'source': source})
+            try:
+                processed = han_decode.parse_data(stored, frame)
+            except ValueError as err:
+                _LOGGER.warning('Could not decode frame: %s', err)
+                invalid += 1
+                continue
+            if not quiet:
+                print(processed)
+    elapsed = perf_counter() - started
+    print('%d frames, %d invalid, %.3f s, %.0f frames/s'
+          % (frames, invalid, elapsed, frames / elapsed if elapsed else 0),
+          file=sys.stderr)
+
+
+def main(argv=None):
+    """Record or replay a capture file."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    record_parser = commands.add_parser('record', help='capture frames')
+    record_parser.add_argument('path')
+    record_parser.add_argument('ports', nargs='+')
+    replay_parser = commands.add_parser('replay', help='replay a capture')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--realtime', action='store_true',
+                               help='pace frames by their timestamps')
+    replay_parser.add_argument('--quiet', action='store_true',
+                               help='only print the throughput')
+    args = parser.parse_args(argv)
+    if args.command == 'record':
+        record(args.path, args.ports)
+    else:
+        run_replay(args.path, args.realtime, args.quiet)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
@@ -0,0 +1,44 @@
+"""
+CRC-16/X-25 for han_kamstrup.
+
+The HDLC header and frame check sequences are CRC-16/X-25: the CCITT
+polynomial, bit reflected, with 0xFFFF as initial value and final xor.
+
+crc_x25() runs in C through binascii.crc_hqx, which computes the same
+polynomial unreflected: the input bytes are bit reversed with
+bytes.translate and the result is reversed back. The translate is a copy
+of the data, and a memoryview is first copied to bytes. To check both
+CRCs of a frame, reflect() the frame once and pass slices of a
+memoryview of it to crc_x25_reflected().
+"""
+
+import binascii
+
+INITIAL = 0xFFFF
+FINAL_XOR = 0xFFFF
+
+
+def _reverse_byte(value):
+    """Return the bits of a byte in reverse order."""
+    return int('{:08b}'.format(value)[::-1], 2)
+
+
+_REVERSE = bytes(_reverse_byte(value) for value in range(256))
+
+
+def reflect(data):
+    """Return a copy of data with the bits of each byte reversed."""
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    return data.translate(_REVERSE)
+
+
+def crc_x25_reflected(reflected):
+    """Return the CRC-16/X-25 of data given as reflect(data)."""
+    crc = binascii.crc_hqx(reflected, INITIAL)
+    return (_REVERSE[crc & 0xFF] << 8 | _REVERSE[crc >> 8]) ^ FINAL_XOR
+
+
+def crc_x25(data):
+    """Return the CRC-16/X-25 of a bytes-like object."""
+    return crc_x25_reflected(reflect(data))
@@ -2,10 +2,23 @@
 Decode for han_kamstrup.
 
 This module will decode the incoming message from Mbus serial.
+
+The first frame of a layout is walked with han_axdr, and its values are
+mapped to fields by their OBIS code. The fields are compiled to fixed
+offset structs and cached by the layout signature: the offsets of the
+A-XDR tags and the OBIS codes, checked with one unpack per frame. Later
+frames of the layout are decoded with one unpack_from call plus a small
+conversion per field.
 """
 
 import logging
 import json
+import struct
+from functools import lru_cache
+from time import perf_counter
+from typing import NamedTuple, Optional
+import han_axdr
+import han_metrics
 
 LIST_TYPE_SHORT_1PH = 17
 LIST_TYPE_LONG_1PH = 27
@@ -31,327 +44,503 @@ METER_TYPE = {
 }
 
 _LOGGER = logging.getLogger(__name__)
-# pylint: disable=too-many-locals, too-many-statements
-
-
-def parse_data(stored, data):
-    """Parse the incoming data to dict."""
-    han_data = stored
-    pkt = data
-    read_packet_size = ((data[1] & 0x0F) << 8 | data[2]) + 2
-    han_data["packet_size"] = read_packet_size
-    date_time_year = pkt[17] << 8 | pkt[18]
-    date_time_month = pkt[19]
-    date_time_date = pkt[20]
-    date_time_hour = str(pkt[22]).zfill(2)
-    date_time_minute = str(pkt[23]).zfill(2)
-    date_time_seconds = str(pkt[24]).zfill(2)
-    date_time_str = (str(date_time_year) +
-                     '-' + str(date_time_month) +
-                     '-' + str(date_time_date) +
-                     ' ' + date_time_hour +
-                     ':' + date_time_minute +
-                     ':' + date_time_seconds)
-    han_data["date_time"] = date_time_str
-    han_data["day_of_week"] = WEEKDAY_MAPPING.get(pkt[21])
-    list_type = pkt[30]
-    han_data["list_type"] = list_type
-    han_data["obis_list_version"] = (chr(pkt[33]) +
-                                     chr(pkt[34]) +
-                                     chr(pkt[35]) +
-                                     chr(pkt[36]) +
-                                     chr(pkt[37]) +
-                                     chr(pkt[38]) +
-                                     chr(pkt[39]) +
-                                     chr(pkt[40]) +
-                                     chr(pkt[41]) +
-                                     chr(pkt[42]) +
-                                     chr(pkt[43]) +
-                                     chr(pkt[44]) +
-                                     chr(pkt[45]) +
-                                     chr(pkt[46]))
-    han_data["obis_m_s"] = (str(pkt[49]) +
-                            '.' + str(pkt[50]) +
-                            '.' + str(pkt[51]) +
-                            '.' + str(pkt[52]) +
-                            '.' + str(pkt[53]) +
-                            '.' + str(pkt[54]))
-    han_data["meter_serial"] = (chr(pkt[57]) +
-                                chr(pkt[58]) +
-                                chr(pkt[59]) +
-                                chr(pkt[60]) +
-                                chr(pkt[61]) +
-                                chr(pkt[62]) +
-                                chr(pkt[63]) +
-                                chr(pkt[64]) +
-                                chr(pkt[65]) +
-                                chr(pkt[66]) +
-                                chr(pkt[67]) +
-                                chr(pkt[68]) +
-                                chr(pkt[69]) +
-                                chr(pkt[70]) +
-                                chr(pkt[71]) +
-                                chr(pkt[72]))
-    han_data["obis_m_t"] = (str(pkt[75]) +
-                            '.' + str(pkt[76]) +
-                            '.' + str(pkt[77]) +
-                            '.' + str(pkt[78]) +
-                            '.' + str(pkt[79]) +
-                            '.' + str(pkt[80]))
-    han_data["meter_type"] = (chr(pkt[83]) +
-                              chr(pkt[84]) +
-                              chr(pkt[85]) +
-                              chr(pkt[86]) +
-                              chr(pkt[87]) +
-                              chr(pkt[88]) +
-                              chr(pkt[89]) +
-                              chr(pkt[90]) +
-                              chr(pkt[91]) +
-                              chr(pkt[92]) +
-                              chr(pkt[93]) +
-                              chr(pkt[94]) +
-                              chr(pkt[95]) +
-                              chr(pkt[96]) +
-                              chr(pkt[97]) +
-                              chr(pkt[98]) +
-                              chr(pkt[99]) +
-                              chr(pkt[100]))
-    han_data["meter_type_str"] = METER_TYPE.get(int(chr(pkt[83]) +
-                                                    chr(pkt[84]) +
-                                                    chr(pkt[85]) +
-                                                    chr(pkt[86]) +
-                                                    chr(pkt[87]) +
-                                                    chr(pkt[88]) +
-                                                    chr(pkt[89])))
-    han_data["obis_a_p_p"] = (str(pkt[103]) +
-                              '.' + str(pkt[104]) +
-                              '.' + str(pkt[105]) +
-                              '.' + str(pkt[106]) +
-                              '.' + str(pkt[107]) +
-                              '.' + str(pkt[108]))
-    han_data["active_power_p"] = (pkt[110] << 24 |
-                                  pkt[111] << 16 |
-                                  pkt[112] << 8 |
-                                  pkt[113])
-    han_data["obis_a_p_n"] = (str(pkt[116]) +
-                              '.' + str(pkt[117]) +
-                              '.' + str(pkt[118]) +
-                              '.' + str(pkt[119]) +
-                              '.' + str(pkt[120]) +
-                              '.' + str(pkt[121]))
-    han_data["active_power_n"] = (pkt[123] << 24 |
-                                  pkt[124] << 16 |
-                                  pkt[125] << 8 |
-                                  pkt[126])
-    han_data["obis_r_p_p"] = (str(pkt[129]) +
-                              '.' + str(pkt[130]) +
-                              '.' + str(pkt[131]) +
-                              '.' + str(pkt[132]) +
-                              '.' + str(pkt[133]) +
-                              '.' + str(pkt[134]))
-    han_data["reactive_power_p"] = (pkt[136] << 24 |
-                                    pkt[137] << 16 |
-                                    pkt[138] << 8 |
-                                    pkt[139])
-    han_data["obis_r_p_n"] = (str(pkt[142]) +
-                              '.' + str(pkt[143]) +
-                              '.' + str(pkt[144]) +
-                              '.' + str(pkt[145]) +
-                              '.' + str(pkt[146]) +
-                              '.' + str(pkt[147]))
-    han_data["reactive_power_n"] = (pkt[149] << 24 |
-                                    pkt[150] << 16 |
-                                    pkt[151] << 8 |
-                                    pkt[152])
-    han_data["obis_c_l1"] = (str(pkt[155]) +
-                             '.' + str(pkt[156]) +
-                             '.' + str(pkt[157]) +
-                             '.' + str(pkt[158]) +
-                             '.' + str(pkt[159]) +
-                             '.' + str(pkt[160]))
-    han_data["current_l1"] = (pkt[162] << 24 |
-                              pkt[163] << 16 |
-                              pkt[164] << 8 |
-                              pkt[165]) / 100
-
-    if (list_type == LIST_TYPE_SHORT_3PH or
-            list_type == LIST_TYPE_LONG_3PH):
-        han_data["obis_c_l2"] = (str(pkt[168]) +
-                                 '.' + str(pkt[169]) +
-                                 '.' + str(pkt[170]) +
-                                 '.' + str(pkt[171]) +
-                                 '.' + str(pkt[172]) +
-                                 '.' + str(pkt[173]))
-        han_data["current_l2"] = (pkt[175] << 24 |
-                                  pkt[176] << 16 |
-                                  pkt[177] << 8 |
-                                  pkt[178]) / 100
-        han_data["obis_c_l3"] = (str(pkt[181]) +
-                                 '.' + str(pkt[182]) +
-                                 '.' + str(pkt[183]) +
-                                 '.' + str(pkt[184]) +
-                                 '.' + str(pkt[185]) +
-                                 '.' + str(pkt[186]))
-        han_data["current_l3"] = (pkt[188] << 24 |
-                                  pkt[189] << 16 |
-                                  pkt[190] << 8 |
-                                  pkt[191]) / 100
-        han_data["obis_v_l1"] = (str(pkt[194]) +
-                                 '.' + str(pkt[195]) +
-                                 '.' + str(pkt[196]) +
-                                 '.' + str(pkt[197]) +
-                                 '.' + str(pkt[198]) +
-                                 '.' + str(pkt[199]))
-        han_data["voltage_l1"] = (pkt[201] << 8 |
-                                  pkt[202])
-        han_data["obis_v_l2"] = (str(pkt[205]) +
-                                 '.' + str(pkt[206]) +
-                                 '.' + str(pkt[207]) +
-                                 '.' + str(pkt[208]) +
-                                 '.' + str(pkt[209]) +
-                                 '.' + str(pkt[210]))
-        han_data["voltage_l2"] = (pkt[212] << 8 |
-                                  pkt[213])
-        han_data["obis_v_l3"] = (str(pkt[216]) +
-                                 '.' + str(pkt[217]) +
-                                 '.' + str(pkt[218]) +
-                                 '.' + str(pkt[219]) +
-                                 '.' + str(pkt[220]) +
-                                 '.' + str(pkt[221]))
-        han_data["voltage_l3"] = (pkt[223] << 8 |
-                                  pkt[224])
-
-    if (list_type == LIST_TYPE_SHORT_1PH or
-            list_type == LIST_TYPE_LONG_1PH):
-
-        han_data["obis_v_l1"] = (str(pkt[168]) +
-                                 '.' + str(pkt[169]) +
-                                 '.' + str(pkt[170]) +
-                                 '.' + str(pkt[171]) +
-                                 '.' + str(pkt[172]) +
-                                 '.' + str(pkt[173]))
-        han_data["voltage_l1"] = (pkt[175] << 8 |
-                                  pkt[176])
-
-    if list_type == LIST_TYPE_LONG_1PH:
-        han_data["obis_meter_date_time"] = (str(pkt[179]) +
-                                            '.' + str(pkt[180]) +
-                                            '.' + str(pkt[181]) +
-                                            '.' + str(pkt[182]) +
-                                            '.' + str(pkt[183]) +
-                                            '.' + str(pkt[184]))
-        meter_date_time_year = pkt[187] << 8 | pkt[188]
-        meter_date_time_month = pkt[189]
-        meter_date_time_date = pkt[190]
-        han_data["meter_day_of_week"] = WEEKDAY_MAPPING.get(pkt[191])
-        meter_date_time_hour = str(pkt[192]).zfill(2)
-        meter_date_time_minute = str(pkt[193]).zfill(2)
-        meter_date_time_seconds = str(pkt[194]).zfill(2)
-        han_data["meter_date_time"] = (str(meter_date_time_year) +
-                                       '-' + str(meter_date_time_month) +
-                                       '-' + str(meter_date_time_date) +
-                                       ' ' + meter_date_time_hour +
-                                       ':' + meter_date_time_minute +
-                                       ':' + meter_date_time_seconds)
-        han_data["obis_a_e_p"] = (str(pkt[201]) +
-                                  '.' + str(pkt[202]) +
-                                  '.' + str(pkt[203]) +
-                                  '.' + str(pkt[204]) +
-                                  '.' + str(pkt[205]) +
-                                  '.' + str(pkt[206]))
-        han_data["active_energy_p"] = (pkt[208] << 24 |
-                                       pkt[209] << 16 |
-                                       pkt[210] << 8 |
-                                       pkt[211]) / 100
-        han_data["obis_a_e_n"] = (str(pkt[214]) +
-                                  '.' + str(pkt[215]) +
-                                  '.' + str(pkt[216]) +
-                                  '.' + str(pkt[217]) +
-                                  '.' + str(pkt[218]) +
-                                  '.' + str(pkt[219]))
-        han_data["active_energy_n"] = (pkt[221] << 24 |
-                                       pkt[222] << 16 |
-                                       pkt[223] << 8 |
-                                       pkt[224]) / 100
-        han_data["obis_r_e_p"] = (str(pkt[227]) +
-                                  '.' + str(pkt[228]) +
-                                  '.' + str(pkt[229]) +
-                                  '.' + str(pkt[230]) +
-                                  '.' + str(pkt[231]) +
-                                  '.' + str(pkt[232]))
-        han_data["reactive_energy_p"] = (pkt[234] << 24 |
-                                         pkt[235] << 16 |
-                                         pkt[236] << 8 |
-                                         pkt[237]) / 100
-        han_data["obis_r_e_n"] = (str(pkt[240]) +
-                                  '.' + str(pkt[241]) +
-                                  '.' + str(pkt[242]) +
-                                  '.' + str(pkt[243]) +
-                                  '.' + str(pkt[244]) +
-                                  '.' + str(pkt[245]))
-        han_data["reactive_energy_n"] = (pkt[247] << 24 |
-                                         pkt[248] << 16 |
-                                         pkt[249] << 8 |
-                                         pkt[250]) / 100
-
-    if list_type == LIST_TYPE_LONG_3PH:
-        han_data["obis_meter_date_time"] = (str(pkt[227]) +
-                                            '.' + str(pkt[228]) +
-                                            '.' + str(pkt[229]) +
-                                            '.' + str(pkt[230]) +
-                                            '.' + str(pkt[231]) +
-                                            '.' + str(pkt[232]))
-        meter_date_time_year = pkt[235] << 8 | pkt[236]
-        meter_date_time_month = pkt[237]
-        meter_date_time_date = pkt[238]
-        han_data["meter_day_of_week"] = WEEKDAY_MAPPING.get(pkt[239])
-        meter_date_time_hour = str(pkt[240]).zfill(2)
-        meter_date_time_minute = str(pkt[241]).zfill(2)
-        meter_date_time_seconds = str(pkt[242]).zfill(2)
-        han_data["meter_date_time"] = (str(meter_date_time_year) +
-                                       '-' + str(meter_date_time_month) +
-                                       '-' + str(meter_date_time_date) +
-                                       ' ' + meter_date_time_hour +
-                                       ':' + meter_date_time_minute +
-                                       ':' + meter_date_time_seconds)
-        han_data["obis_a_e_p"] = (str(pkt[249]) +
-                                  '.' + str(pkt[250]) +
-                                  '.' + str(pkt[251]) +
-                                  '.' + str(pkt[252]) +
-                                  '.' + str(pkt[253]) +
-                                  '.' + str(pkt[254]))
-        han_data["active_energy_p"] = (pkt[256] << 24 |
-                                       pkt[257] << 16 |
-                                       pkt[258] << 8 |
-                                       pkt[259]) / 100
-        han_data["obis_a_e_n"] = (str(pkt[262]) +
-                                  '.' + str(pkt[263]) +
-                                  '.' + str(pkt[264]) +
-                                  '.' + str(pkt[265]) +
-                                  '.' + str(pkt[266]) +
-                                  '.' + str(pkt[267]))
-        han_data["active_energy_n"] = (pkt[269] << 24 |
-                                       pkt[270] << 16 |
-                                       pkt[271] << 8 |
-                                       pkt[272]) / 100
-        han_data["obis_r_e_p"] = (str(pkt[275]) +
-                                  '.' + str(pkt[276]) +
-                                  '.' + str(pkt[277]) +
-                                  '.' + str(pkt[278]) +
-                                  '.' + str(pkt[279]) +
-                                  '.' + str(pkt[280]))
-        han_data["reactive_energy_p"] = (pkt[282] << 24 |
-                                         pkt[283] << 16 |
-                                         pkt[284] << 8 |
-                                         pkt[285]) / 100
-        han_data["obis_r_e_n"] = (str(pkt[288]) +
-                                  '.' + str(pkt[289]) +
-                                  '.' + str(pkt[290]) +
-                                  '.' + str(pkt[291]) +
-                                  '.' + str(pkt[292]) +
-                                  '.' + str(pkt[293]))
-        han_data["reactive_energy_n"] = (pkt[295] << 24 |
-                                         pkt[296] << 16 |
-                                         pkt[297] << 8 |
-                                         pkt[298]) / 100
-    return json.dumps(han_data)
+
+
+class HanReading(NamedTuple):
+    """A decoded HAN frame. Fields not present in the list type are None."""
+
+    # pylint: disable=too-few-public-methods
+    packet_size: int
+    date_time: str
+    day_of_week: Optional[str]
+    list_type: int
+    obis_list_version: str
+    obis_m_s: str
+    meter_serial: str
+    obis_m_t: str
+    meter_type: str
+    meter_type_str: Optional[str]
+    obis_a_p_p: str
+    active_power_p: int
+    obis_a_p_n: str
+    active_power_n: int
+    obis_r_p_p: str
+    reactive_power_p: int
+    obis_r_p_n: str
+    reactive_power_n: int
+    obis_c_l1: str
+    current_l1: float
+    obis_c_l2: Optional[str] = None
+    current_l2: Optional[float] = None
+    obis_c_l3: Optional[str] = None
+    current_l3: Optional[float] = None
+    obis_v_l1: Optional[str] = None
+    voltage_l1: Optional[int] = None
+    obis_v_l2: Optional[str] = None
+    voltage_l2: Optional[int] = None
+    obis_v_l3: Optional[str] = None
+    voltage_l3: Optional[int] = None
+    obis_meter_date_time: Optional[str] = None
+    meter_day_of_week: Optional[str] = None
+    meter_date_time: Optional[str] = None
+    obis_a_e_p: Optional[str] = None
+    active_energy_p: Optional[float] = None
+    obis_a_e_n: Optional[str] = None
+    active_energy_n: Optional[float] = None
+    obis_r_e_p: Optional[str] = None
+    reactive_energy_p: Optional[float] = None
+    obis_r_e_n: Optional[str] = None
+    reactive_energy_n: Optional[float] = None
+
+    def as_dict(self):
+        """Return the fields present in this frame as a dict."""
+        return {key: value for key, value in zip(self._fields, self)
+                if value is not None}
+
+
+_DATE_TIME = struct.Struct('>HBBBBBB')
+
+
+def _packet_size(frame_format):
+    """Return the frame size given by the HDLC frame format field."""
+    return (frame_format & 0x0FFF) + 2
+
+
+@lru_cache(maxsize=256)
+def _obis(raw):
+    """Format a 6 byte OBIS code."""
+    return '%d.%d.%d.%d.%d.%d' % tuple(raw)
+
+
+def _text(raw):
+    """Decode a visible-string, one character per byte."""
+    return raw.decode('latin-1')
+
+
+def _hundredths(value):
+    """Scale a value given in 1/100 units."""
+    return value / 100
+
+
+def _date_time(raw):
+    """Return the date-time string and weekday of a COSEM date-time."""
+    year, month, date, weekday, hour, minute, seconds = \
+        _DATE_TIME.unpack_from(raw)
+    return ('%d-%d-%d %02d:%02d:%02d' % (year, month, date,
+                                         hour, minute, seconds),
+            WEEKDAY_MAPPING.get(weekday))
+
+
+def _meter_type(raw):
+    """Return the meter type and its description."""
+    meter_type = _text(raw)
+    return meter_type, METER_TYPE.get(int(meter_type[:7]))
+
+
+# kind: (struct format, converter). '%ds' formats take the field size.
+_KINDS = {
+    'frame_format': ('H', _packet_size),
+    'list_type': ('B', None),
+    'uint8': ('B', None),
+    'int8': ('b', None),
+    'uint16': ('H', None),
+    'int16': ('h', None),
+    'uint32': ('I', None),
+    'int32': ('i', None),
+    'hundredths': ('I', _hundredths),
+    'signed_hundredths': ('i', _hundredths),
+    'obis': ('6s', _obis),
+    'date_time': ('%ds', _date_time),
+    'text': ('%ds', _text),
+    'meter_serial': ('%ds', _text),
+    'meter_type': ('%ds', _meter_type),
+}
+
+# Kinds of the fields that do not change between frames of a meter.
+_STATIC_KINDS = frozenset((
+    'frame_format', 'list_type', 'text', 'meter_serial', 'meter_type'))
+
+# Kind of an integer value by A-XDR tag, unscaled and in 1/100 units.
+_INTEGER_KINDS = {
+    han_axdr.UNSIGNED: ('uint8', None),
+    han_axdr.INTEGER: ('int8', None),
+    han_axdr.LONG_UNSIGNED: ('uint16', None),
+    han_axdr.LONG: ('int16', None),
+    han_axdr.DOUBLE_LONG_UNSIGNED: ('uint32', 'hundredths'),
+    han_axdr.DOUBLE_LONG: ('int32', 'signed_hundredths'),
+}
+
+# C, D and E group of an OBIS code: (field of the code, field of the value)
+OBIS_FIELDS = {
+    (0, 0, 5): ('obis_m_s', 'meter_serial'),
+    (96, 1, 1): ('obis_m_t', ('meter_type', 'meter_type_str')),
+    (1, 7, 0): ('obis_a_p_p', 'active_power_p'),
+    (2, 7, 0): ('obis_a_p_n', 'active_power_n'),
+    (3, 7, 0): ('obis_r_p_p', 'reactive_power_p'),
+    (4, 7, 0): ('obis_r_p_n', 'reactive_power_n'),
+    (31, 7, 0): ('obis_c_l1', 'current_l1'),
+    (51, 7, 0): ('obis_c_l2', 'current_l2'),
+    (71, 7, 0): ('obis_c_l3', 'current_l3'),
+    (32, 7, 0): ('obis_v_l1', 'voltage_l1'),
+    (52, 7, 0): ('obis_v_l2', 'voltage_l2'),
+    (72, 7, 0): ('obis_v_l3', 'voltage_l3'),
+    (1, 0, 0): ('obis_meter_date_time',
+                ('meter_date_time', 'meter_day_of_week')),
+    (1, 8, 0): ('obis_a_e_p', 'active_energy_p'),
+    (2, 8, 0): ('obis_a_e_n', 'active_energy_n'),
+    (3, 8, 0): ('obis_r_e_p', 'reactive_energy_p'),
+    (4, 8, 0): ('obis_r_e_n', 'reactive_energy_n'),
+}
+
+# Values sent in 1/100 units.
+_HUNDREDTHS = frozenset((
+    'current_l1', 'current_l2', 'current_l3',
+    'active_energy_p', 'active_energy_n',
+    'reactive_energy_p', 'reactive_energy_n',
+))
+
+MAX_CACHED_LAYOUTS = 64
+MAX_CACHED_HEADERS = 1024
+
+
+def _value_kind(names, element):
+    """Return the kind of a value field, or None if it is not supported."""
+    tag = element.tag
+    # Fields decoded into two names only come from their own tag.
+    if isinstance(names, tuple):
+        if names[0].endswith('date_time'):
+            if tag == han_axdr.OCTET_STRING and element.size >= 8:
+                return 'date_time'
+        elif tag == han_axdr.VISIBLE_STRING:
+            return 'meter_type'
+        return None
+    if tag in _INTEGER_KINDS:
+        kind, scaled = _INTEGER_KINDS[tag]
+        if names in _HUNDREDTHS:
+            return scaled
+        return kind
+    if tag != han_axdr.VISIBLE_STRING:
+        return None
+    if names == 'meter_serial':
+        return 'meter_serial'
+    return 'text'
+
+
+def frame_fields(data):
+    """Walk a frame and return its fields and layout signature.
+
+    The fields are (field name(s), offset, kind, size) tuples. The
+    signature is a list of (offset, struct format) of the tags, lengths
+    and OBIS codes that must match for another frame to share the layout.
+    """
+    notification = han_axdr.notification(data)
+    body = notification.body
+    fields = [('packet_size', 1, 'frame_format', 2)]
+    signature = [(han_axdr.DATE_TIME_OFFSET, 'B'), (body.offset, 'B')]
+    if notification.date_time.size >= 8:
+        fields.append((('date_time', 'day_of_week'),
+                       notification.date_time.value_offset, 'date_time',
+                       notification.date_time.size))
+    fields.append(('list_type', body.offset + 1, 'list_type', 1))
+
+    elements = iter(notification.elements)
+    first = notification.elements[:1]
+    if first and first[0].tag == han_axdr.VISIBLE_STRING:
+        # The list version is the first element of the body.
+        version = next(elements)
+        signature.extend(((version.offset, 'B'), (version.offset + 1, 'B')))
+        fields.append(('obis_list_version', version.value_offset, 'text',
+                       version.size))
+    for element in elements:
+        signature.append((element.offset, 'B'))
+        if element.tag in han_axdr.STRINGS:
+            signature.append((element.offset + 1, 'B'))
+        if element.tag != han_axdr.OCTET_STRING or element.size != 6:
+            _LOGGER.debug('Skipping element %s', element)
+            continue
+        code = bytes(data[element.value_offset:element.value_offset + 6])
+        signature.append((element.value_offset, '6s'))
+        value = next(elements, None)
+        if value is None:
+            break
+        signature.append((value.offset, 'B'))
+        if value.tag in han_axdr.STRINGS:
+            signature.append((value.offset + 1, 'B'))
+        names = OBIS_FIELDS.get(tuple(code[2:5]))
+        if names is None:
+            _LOGGER.debug('Skipping unknown OBIS code %s', _obis(code))
+            continue
+        kind = _value_kind(names[1], value)
+        if kind is None:
+            _LOGGER.debug('Skipping %s with tag %#x', names[1], value.tag)
+            continue
+        fields.append((names[0], element.value_offset, 'obis', 6))
+        fields.append((names[1], value.value_offset, kind, value.size))
+    return fields, signature
+
+
+class _Layout(NamedTuple):
+    """A frame layout compiled to structs and their converters.
+
+    A frame has this layout if signature unpacks to expected. The OBIS
+    code fields are part of the signature and are decoded once into
+    base. The static fields are unpacked as raw bytes and used as the key
+    of headers, which holds the decoded static fields of each meter seen.
+    accessors holds a (struct, converter, names) per field name for
+    decoding one field at a time.
+    """
+
+    # pylint: disable=too-few-public-methods
+    signature: struct.Struct
+    expected: tuple
+    base: list
+    static: struct.Struct
+    static_fields: tuple
+    unpacker: struct.Struct
+    fields: tuple
+    headers: dict
+    accessors: dict
+
+
+def _struct_at(items):
+    """Return a struct reading (offset, format) items, in offset order."""
+    fmt = ['>']
+    position = 0
+    for offset, code in items:
+        if offset < position:
+            raise ValueError('Overlapping field at %s' % offset)
+        if offset > position:
+            fmt.append('%dx' % (offset - position))
+        fmt.append(code)
+        position = offset + struct.calcsize('>' + code)
+    return struct.Struct(''.join(fmt))
+
+
+_INDEX = {name: pos for pos, name in enumerate(HanReading._fields)}
+
+
+def _target(names):
+    """Return the index or slice of field name(s) in a HanReading."""
+    if not isinstance(names, tuple):
+        return _INDEX[names]
+    first, last = _INDEX[names[0]], _INDEX[names[-1]]
+    step = 1 if last > first else -1
+    return slice(first, last + step, step)
+
+
+def _compile_struct(fields):
+    """Compile fields to one struct and a (target, converter) per field."""
+    items = []
+    compiled = []
+    for names, offset, kind, size in sorted(fields,
+                                            key=lambda field: field[1]):
+        code, conv = _KINDS[kind]
+        if '%' in code:
+            code = code % size
+        items.append((offset, code))
+        compiled.append((_target(names), conv))
+    return _struct_at(items), tuple(compiled)
+
+
+def _accessors(fields):
+    """Compile a struct reading each field on its own, by field name."""
+    accessors = {}
+    for names, offset, kind, size in fields:
+        code, conv = _KINDS[kind]
+        if '%' in code:
+            code = code % size
+        accessor = (struct.Struct('>%dx%s' % (offset, code)), conv,
+                    names if isinstance(names, tuple) else None)
+        for name in names if isinstance(names, tuple) else (names,):
+            accessors[name] = accessor
+    return accessors
+
+
+def compile_layout(data):
+    """Walk a frame and compile its layout."""
+    fields, signature = frame_fields(data)
+    signature = _struct_at(sorted(signature))
+    base = _EMPTY[:]
+    static, dynamic = [], []
+    for field in fields:
+        names, offset, kind, _ = field
+        if kind == 'obis':
+            base[_target(names)] = _obis(bytes(data[offset:offset + 6]))
+        elif kind in _STATIC_KINDS:
+            static.append(field)
+        else:
+            dynamic.append(field)
+    return _Layout(signature, signature.unpack_from(data), base,
+                   *_compile_struct(static), *_compile_struct(dynamic), {},
+                   _accessors(static + dynamic))
+
+
+def _convert(fields, raw_values, values):
+    """Convert raw values into their place in values."""
+    for (target, conv), raw in zip(fields, raw_values):
+        values[target] = conv(raw) if conv else raw
+
+
+_EMPTY = [None] * len(HanReading._fields)
+
+# (frame size, list type): the last layout seen for them.
+_LAYOUTS = {}
+
+
+def _layout(data):
+    """Return the compiled layout of a frame."""
+    key = (len(data), data[30])
+    layout = _LAYOUTS.get(key)
+    if layout is None or layout.signature.unpack_from(data) != \
+            layout.expected:
+        layout = compile_layout(data)
+        if len(_LAYOUTS) >= MAX_CACHED_LAYOUTS:
+            _LAYOUTS.clear()
+        _LAYOUTS[key] = layout
+    return layout
+
+
+def layout_key(data):
+    """Return a key that is equal for frames of the same layout.
+
+    Frames with equal keys have their fields at the same offsets, with
+    the same tags and OBIS codes. Raises ValueError if the frame can not
+    be walked.
+    """
+    layout = _layout(data)
+    return layout.signature.format, layout.expected
+
+
+def decode_frame(data):
+    """Decode a validated frame to a HanReading.
+
+    Raises ValueError if the frame is not a data-notification that can be
+    walked.
+    """
+    started = perf_counter()
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+    reading = HanReading._make(_values(_layout(data), data))
+    han_metrics.FRAMES.inc(reading.list_type)
+    han_metrics.STAGE_SECONDS.observe('decode', value=perf_counter() - started)
+    return reading
+
+
+def _values(layout, data):
+    """Return the values of every HanReading field of a frame."""
+    header = layout.static.unpack_from(data)
+    values = layout.headers.get(header)
+    if values is None:
+        if len(layout.headers) >= MAX_CACHED_HEADERS:
+            layout.headers.clear()
+        values = layout.base[:]
+        _convert(layout.static_fields, header, values)
+        layout.headers[header] = values
+    values = values[:]
+    _convert(layout.fields, layout.unpacker.unpack_from(data), values)
+    return values
+
+
+class FrameView():
+    """A validated frame decoded one field at a time.
+
+    Has the fields of HanReading. A field is decoded the first time it
+    is read and kept in its slot, so reading a few fields of a frame
+    costs a few small unpacks instead of decoding the whole frame.
+    """
+
+    __slots__ = ('_data', '_layout') + HanReading._fields
+
+    def __init__(self, data, layout=None):
+        """Initialize variables."""
+        if not isinstance(data, bytes):
+            # Frames from the readers are views into a reused buffer.
+            data = bytes(data)
+        self._data = data
+        self._layout = layout or _layout(data)
+
+    def __getattr__(self, name):
+        """Decode a field on first access."""
+        index = _INDEX.get(name)
+        if index is None:
+            # Also covers _layout before it is set, as in copy.copy.
+            raise AttributeError(name)
+        accessor = self._layout.accessors.get(name)
+        if accessor is None:
+            value = self._layout.base[index]
+            setattr(self, name, value)
+            return value
+        unpacker, conv, names = accessor
+        value = unpacker.unpack_from(self._data)[0]
+        if conv:
+            value = conv(value)
+        if names is None:
+            setattr(self, name, value)
+            return value
+        for part_name, part in zip(names, value):
+            setattr(self, part_name, part)
+        return getattr(self, name)
+
+    def __getstate__(self):
+        """Return the frame, from which the view is rebuilt."""
+        return self._data
+
+    def __setstate__(self, state):
+        """Rebuild the view of a copied or unpickled frame."""
+        self._data = state
+        self._layout = _layout(state)
+
+    def __repr__(self):
+        """Return the fields decoded so far."""
+        decoded = []
+        for name in HanReading._fields:
+            try:
+                value = getattr(type(self), name).__get__(self)
+            except AttributeError:
+                continue
+            decoded.append('%s=%r' % (name, value))
+        return 'FrameView(%s)' % ', '.join(decoded)
+
+    def to_reading(self):
+        """Decode every field at once and return them as a HanReading."""
+        return HanReading._make(_values(self._layout, self._data))
+
+    def to_dict(self):
+        """Return every field present in the frame as a dict."""
+        return self.to_reading().as_dict()
+
+    def to_json(self):
+        """Return every field present in the frame as JSON."""
+        return json.dumps(self.to_dict())
+
+
+def decode_lazy(data):
+    """Return a FrameView of a validated frame.
+
+    Raises ValueError if the frame is not a data-notification that can be
+    walked.
+    """
+    started = perf_counter()
+    view = FrameView(data)
+    han_metrics.FRAMES.inc(view.list_type)
+    han_metrics.STAGE_SECONDS.observe('decode', value=perf_counter() - started)
+    return view
+
+
+def parse_data(stored, data, delta=False, lazy=False):
+    """Parse the incoming data to dict.
+
+    With delta, only the values that changed since the last frame stored
+    in stored are returned. With lazy, a FrameView is returned instead of
+    JSON and stored is not used.
+    """
+    if lazy:
+        return decode_lazy(data)
+    reading = decode_frame(data).as_dict()
+    if delta:
+        reading = {key: value for key, value in reading.items()
+                   if key not in stored or stored[key] != value}
+        stored.update(reading)
+        return json.dumps(reading)
+    stored.update(reading)
+    return json.dumps(stored)
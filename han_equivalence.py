@@ -0,0 +1,72 @@
+"""
+Check the decoder of han_kamstrup against the original parse_data.
+
+Random frames of every list type are made with han_synth and decoded by
+the original byte offset parse_data of han_legacy and by han_decode,
+eagerly and lazily. The JSON output must be the same. The first frame
+that differs is printed, and the exit status is 1.
+
+    python han_equivalence.py [--frames N] [--seed N]
+"""
+
+import argparse
+import json
+import random
+import sys
+import han_decode
+import han_legacy
+import han_synth
+
+FRAMES = 2000
+
+
+def _decoders():
+    """Return the decoders compared with the original parse_data."""
+    return {
+        'parse_data': lambda frame: han_decode.parse_data({}, frame),
+        'parse_data list':
+            lambda frame: han_decode.parse_data({}, list(frame)),
+        'parse_data lazy':
+            lambda frame: han_decode.parse_data({}, frame,
+                                                lazy=True).to_json(),
+    }
+
+
+def check(count, seed):
+    """Compare the decoders on count random frames.
+
+    Returns None if all agree, or (decoder name, frame, expected, got)
+    for the first difference.
+    """
+    rng = random.Random(seed)
+    decoders = _decoders()
+    for _ in range(count):
+        frame = han_synth.random_frame(rng.choice(han_synth.LIST_TYPES), rng)
+        expected = json.loads(han_legacy.parse_data({}, frame))
+        for name, decode in decoders.items():
+            got = json.loads(decode(frame))
+            if got != expected:
+                return name, frame, expected, got
+    return None
+
+
+def main(argv=None):
+    """Run the check and report the result."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    difference = check(args.frames, args.seed)
+    if difference is None:
+        print('%d frames decoded the same' % args.frames)
+        return
+    name, frame, expected, got = difference
+    print('%s differs on %s' % (name, bytes(frame).hex()))
+    for key in sorted(set(expected) | set(got)):
+        if expected.get(key) != got.get(key):
+            print('  %s: %r != %r' % (key, expected.get(key), got.get(key)))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
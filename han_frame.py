@@ -0,0 +1,116 @@
+"""
+HDLC framer for han_kamstrup.
+
+Splits a stream of bytes from the Mbus serial adapter into HDLC frames.
+Bytes are kept in a fixed size bytearray and complete frames are
+returned as memoryviews into it, so no copy is made per frame.
+"""
+
+import logging
+from time import perf_counter
+
+FLAG = 0x7E
+FRAME_TYPE = 0xA0
+MIN_FRAME_SIZE = 9
+MAX_FRAME_SIZE = 512
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class HdlcFramer():
+    """Incremental HDLC framer.
+
+    Feed it bytes as they arrive and iterate over it for complete frames.
+    A frame is found from its opening flag, its length from the frame
+    format field in bytes 1-2 and a closing flag at that length. Returned
+    frames are views into the framer buffer and are only valid until the
+    next call to feed(). read_seconds is the time from the feed that
+    brought the first byte of the last frame to the one that completed it.
+    """
+
+    def __init__(self, max_size=MAX_FRAME_SIZE, capacity=None):
+        """Initialize variables."""
+        self.max_size = max_size
+        self.capacity = capacity or 4 * max_size
+        self._buffer = bytearray(self.capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.dropped = 0
+        self.started = None
+        self.read_seconds = 0.0
+        self._fed = None
+
+    def __len__(self):
+        """Return the number of buffered bytes not yet framed."""
+        return self._end - self._start
+
+    def __iter__(self):
+        """Iterate over the complete frames in the buffer."""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def feed(self, data):
+        """Append received bytes to the buffer."""
+        self._fed = perf_counter()
+        if self.started is None:
+            self.started = self._fed
+        size = len(data)
+        if size > self.capacity:
+            self.dropped += size - self.capacity
+            data = data[-self.capacity:]
+            size = self.capacity
+        if self._end + size > self.capacity:
+            self._compact(size)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def _compact(self, size):
+        """Move pending bytes to the front to make room for size bytes."""
+        pending = self._end - self._start
+        if pending + size > self.capacity:
+            overflow = pending + size - self.capacity
+            _LOGGER.warning('Framer buffer full, dropping %s bytes',
+                            overflow)
+            self.dropped += overflow
+            self._start += overflow
+            pending -= overflow
+        self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def next_frame(self):
+        """Return the next complete frame, or None if there is none yet."""
+        buffer = self._buffer
+        while True:
+            start = buffer.find(FLAG, self._start, self._end)
+            if start < 0:
+                self._start = self._end = 0
+                return None
+            self._start = start
+            if self._end - start < 3:
+                return None
+            frame_format = buffer[start + 1]
+            if (frame_format & 0xF0) != FRAME_TYPE:
+                self._start = start + 1
+                continue
+            size = ((frame_format & 0x0F) << 8 | buffer[start + 2]) + 2
+            if size < MIN_FRAME_SIZE or size > self.max_size:
+                self._start = start + 1
+                continue
+            stop = start + size
+            if stop > self._end:
+                return None
+            if buffer[stop - 1] != FLAG:
+                self._start = start + 1
+                continue
+            # The closing flag may also open the next frame.
+            self._start = stop - 1
+            # Bytes after the closing flag start the next frame.
+            started = self.started
+            self.started = self._fed if self._end > stop else None
+            self.read_seconds = (0.0 if started is None
+                                 else perf_counter() - started)
+            return self._view[start:stop]
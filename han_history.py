@@ -0,0 +1,231 @@
+"""
+In-memory history of readings for han_kamstrup.
+
+Keeps the last samples of each numeric measurement of a meter in
+fixed size arrays, with rolling min, max and mean over time windows.
+The aggregates are updated as samples are added, in amortized constant
+time: running sums for the mean, and monotonic queues for min and max.
+Memory is bounded by the capacity given per meter.
+"""
+
+from array import array
+from collections import deque
+from collections.abc import Mapping
+from time import time
+
+MEASUREMENTS = (
+    'active_power_p', 'active_power_n',
+    'reactive_power_p', 'reactive_power_n',
+    'current_l1', 'current_l2', 'current_l3',
+    'voltage_l1', 'voltage_l2', 'voltage_l3',
+    'active_energy_p', 'active_energy_n',
+    'reactive_energy_p', 'reactive_energy_n',
+)
+
+ENERGIES = frozenset((
+    'active_energy_p', 'active_energy_n',
+    'reactive_energy_p', 'reactive_energy_n',
+))
+
+# One minute, 15 minutes and one hour.
+WINDOWS = (60, 900, 3600)
+
+# One hour of 10 second lists.
+CAPACITY = 360
+
+_NAN = float('nan')
+
+
+class _Window():
+    """Rolling aggregates of every measurement over a time window."""
+
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('seconds', 'start', 'sums', 'counts', 'mins', 'maxs')
+
+    def __init__(self, seconds, measurements):
+        """Initialize variables."""
+        self.seconds = seconds
+        self.start = 0
+        self.sums = [0.0] * measurements
+        self.counts = [0] * measurements
+        # Queues of sample numbers with increasing and decreasing values.
+        self.mins = [deque() for _ in range(measurements)]
+        self.maxs = [deque() for _ in range(measurements)]
+
+
+class ReadingHistory():
+    """The last samples of one meter, with rolling window aggregates.
+
+    Windows longer than capacity samples cover only the last capacity
+    samples.
+    """
+
+    def __init__(self, capacity=CAPACITY, windows=WINDOWS,
+                 measurements=MEASUREMENTS):
+        """Initialize variables."""
+        self.capacity = capacity
+        self.measurements = tuple(measurements)
+        self._times = array('d', [0.0]) * capacity
+        self._values = [array('d', [_NAN]) * capacity
+                        for _ in self.measurements]
+        self._count = 0
+        self._windows = {seconds: _Window(seconds, len(self.measurements))
+                         for seconds in windows}
+
+    def __len__(self):
+        """Return the number of samples held."""
+        return min(self._count, self.capacity)
+
+    def add(self, reading, timestamp=None):
+        """Add a reading, such as a HanReading, received at timestamp.
+
+        The reading can also be a mapping of measurement names, such as
+        the dict of as_dict(). Measurements the reading does not have are
+        stored as NaN and left out of the aggregates.
+        """
+        if timestamp is None:
+            timestamp = time()
+        number = self._count
+        # Expire before the new sample overwrites the oldest slot.
+        for window in self._windows.values():
+            self._expire(window, timestamp - window.seconds,
+                         number + 1 - self.capacity, number)
+        slot = number % self.capacity
+        self._times[slot] = timestamp
+        if isinstance(reading, Mapping):
+            values = map(reading.get, self.measurements)
+        else:
+            values = (getattr(reading, name, None)
+                      for name in self.measurements)
+        new = []
+        for index, value in enumerate(values):
+            value = _NAN if value is None else float(value)
+            self._values[index][slot] = value
+            if value == value:
+                new.append((index, value))
+        self._count += 1
+        capacity = self.capacity
+        for window in self._windows.values():
+            for index, value in new:
+                samples = self._values[index]
+                window.sums[index] += value
+                window.counts[index] += 1
+                mins = window.mins[index]
+                while mins and samples[mins[-1] % capacity] >= value:
+                    mins.pop()
+                mins.append(number)
+                maxs = window.maxs[index]
+                while maxs and samples[maxs[-1] % capacity] <= value:
+                    maxs.pop()
+                maxs.append(number)
+
+    def _value(self, index, number):
+        """Return the value of a measurement in sample number."""
+        return self._values[index][number % self.capacity]
+
+    def _expire(self, window, oldest_time, oldest_number, stop):
+        """Drop the samples before stop that are too old for a window."""
+        while window.start < stop and (
+                window.start < oldest_number or
+                self._times[window.start % self.capacity] <= oldest_time):
+            number = window.start
+            slot = number % self.capacity
+            for index, samples in enumerate(self._values):
+                value = samples[slot]
+                if value != value:
+                    continue
+                window.sums[index] -= value
+                window.counts[index] -= 1
+                if window.mins[index][0] == number:
+                    window.mins[index].popleft()
+                if window.maxs[index][0] == number:
+                    window.maxs[index].popleft()
+            window.start += 1
+
+    def values(self, name):
+        """Return the held samples of a measurement, oldest first."""
+        return self._ordered(self._values[self.measurements.index(name)])
+
+    def times(self):
+        """Return the timestamps of the held samples, oldest first."""
+        return self._ordered(self._times)
+
+    def _ordered(self, samples):
+        """Return a copy of a ring array in sample order."""
+        if self._count <= self.capacity:
+            return samples[:self._count]
+        slot = self._count % self.capacity
+        return samples[slot:] + samples[:slot]
+
+    def latest(self, name):
+        """Return the last value of a measurement, or None."""
+        if not self._count:
+            return None
+        value = self._value(self.measurements.index(name), self._count - 1)
+        return None if value != value else value
+
+    def aggregate(self, name, seconds, now=None):
+        """Return min, max, mean and count of a measurement in a window.
+
+        The window ends at the last sample, or at now if given, so the
+        aggregates of a meter that stopped sending run empty. now must not
+        be before the timestamp of a sample added later. For energies,
+        which are counters, delta is the increase over the window.
+        Returns None if the window has no value.
+        """
+        index = self.measurements.index(name)
+        window = self._windows[seconds]
+        if now is not None:
+            self._expire(window, now - seconds, self._count - self.capacity,
+                         self._count)
+        count = window.counts[index]
+        if not count:
+            return None
+        result = {
+            'min': self._value(index, window.mins[index][0]),
+            'max': self._value(index, window.maxs[index][0]),
+            'mean': window.sums[index] / count,
+            'count': count,
+        }
+        if name in ENERGIES:
+            result['delta'] = result['max'] - result['min']
+        return result
+
+    def aggregates(self, seconds, now=None):
+        """Return the aggregates of every measurement in a window."""
+        result = {}
+        for name in self.measurements:
+            aggregate = self.aggregate(name, seconds, now)
+            if aggregate is not None:
+                result[name] = aggregate
+        return result
+
+
+class HistoryStore():
+    """A ReadingHistory per meter, created when a meter is first seen."""
+
+    def __init__(self, capacity=CAPACITY, windows=WINDOWS,
+                 measurements=MEASUREMENTS):
+        """Initialize variables."""
+        self.capacity = capacity
+        self.windows = windows
+        self.measurements = measurements
+        self.meters = {}
+
+    def add(self, source, reading, timestamp=None):
+        """Add a reading of the meter source."""
+        history = self.meters.get(source)
+        if history is None:
+            history = self.meters[source] = ReadingHistory(
+                self.capacity, self.windows, self.measurements)
+        history.add(reading, timestamp)
+        return history
+
+    def __getitem__(self, source):
+        """Return the history of a meter."""
+        return self.meters[source]
+
+    def bytes_used(self):
+        """Return the size of the sample arrays of all meters."""
+        per_sample = 8 * (1 + len(self.measurements))
+        return len(self.meters) * self.capacity * per_sample
@@ -0,0 +1,251 @@
+"""
+Parallel bulk ingestion of capture files for han_kamstrup.
+
+Validating and decoding a backfill of captured frames is bound by the
+CPU, so the captures are cut into shards and decoded by a pool of
+processes. A capture larger than the chunk size is cut into byte ranges
+at record boundaries. The parent only walks the record headers to find
+them. Workers map the capture files themselves, so frames are never
+pickled, and each shard is decoded, encoded with a han_sinks encoder and
+spooled to a temporary file in timestamp order. The spools are merged
+by timestamp into one output, at most MERGE_FAN_IN at a time, so the
+number of open files stays bounded however many shards there are:
+
+    capture files -> shards -> workers -> spools -> merge -> output
+
+Progress and throughput are printed to stderr as the shards finish.
+
+    python han_ingest.py capture.han [capture.han ...] [--workers N]
+        [--chunk-bytes B] [--format F] [--output O]
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+from operator import itemgetter
+from time import perf_counter
+import han_capture
+import han_decode
+import han_kamstrup
+import han_sinks
+
+CHUNK_BYTES = 16 * 1024 * 1024
+# timestamp and length of an encoded reading in a spool file.
+SPOOL_RECORD = struct.Struct('<dI')
+# Spools merged at once; more are merged in passes through new spools.
+MERGE_FAN_IN = 64
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def plan(paths, chunk_bytes=CHUNK_BYTES):
+    """Return the shards of captures as (path, start, stop) offsets."""
+    shards = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if size <= len(han_capture.MAGIC):
+            continue
+        if size <= chunk_bytes:
+            shards.append((path, None, None))
+            continue
+        with han_capture.CaptureReader(path) as reader:
+            shards.extend((path, start, stop)
+                          for start, stop in reader.chunks(chunk_bytes))
+    return shards
+
+
+def ingest_shard(task):
+    """Decode a shard and spool its encoded readings in timestamp order.
+
+    task is (index, (path, start, stop), format, spool directory).
+    Returns the index, the spool path or None if no frame decoded, and
+    the counters of the shard.
+    """
+    index, (path, start, stop), output_format, directory = task
+    encoder = han_sinks.ENCODERS[output_format]
+    stats = {'frames': 0, 'invalid': 0, 'bytes': 0}
+    rows = []
+    with han_capture.CaptureReader(path) as reader:
+        for timestamp, _, frame in reader.records(start, stop):
+            stats['frames'] += 1
+            stats['bytes'] += han_capture.RECORD.size + len(frame)
+            if han_kamstrup.check_frame(frame) is not None:
+                stats['invalid'] += 1
+                continue
+            try:
+                reading = han_decode.decode_frame(frame)
+            except ValueError as err:
+                _LOGGER.warning('Could not decode frame: %s', err)
+                stats['invalid'] += 1
+                continue
+            rows.append((timestamp, encoder(reading, timestamp)))
+    if not rows:
+        return index, None, stats
+    # Captures are appended as frames arrive, so this is mostly sorted.
+    rows.sort(key=itemgetter(0))
+    spool = os.path.join(directory, '%08d.spool' % index)
+    write_spool(spool, rows)
+    return index, spool, stats
+
+
+def write_spool(path, rows):
+    """Write (timestamp, data) rows to a spool file."""
+    pack = SPOOL_RECORD.pack
+    with open(path, 'wb') as spool_file:
+        for timestamp, data in rows:
+            spool_file.write(pack(timestamp, len(data)))
+            spool_file.write(data)
+
+
+def read_spool(path):
+    """Yield (timestamp, data) from a spool file."""
+    unpack = SPOOL_RECORD.unpack
+    header_size = SPOOL_RECORD.size
+    with open(path, 'rb') as spool_file:
+        while True:
+            header = spool_file.read(header_size)
+            if len(header) < header_size:
+                return
+            timestamp, length = unpack(header)
+            yield timestamp, spool_file.read(length)
+
+
+def merge_spools(spools, directory, fan_in=MERGE_FAN_IN):
+    """Iterate over the rows of spools in timestamp order.
+
+    Rows with the same timestamp keep the order of the spools. At most
+    fan_in spools are open at once: runs of fan_in spools are merged into
+    new spools in directory, and removed, until fan_in or fewer are left.
+    """
+    passes = 0
+    while len(spools) > fan_in:
+        passes += 1
+        merged = []
+        for first in range(0, len(spools), fan_in):
+            run = spools[first:first + fan_in]
+            path = os.path.join(directory, 'merge-%d-%08d.spool'
+                                % (passes, first // fan_in))
+            write_spool(path, heapq.merge(*map(read_spool, run),
+                                          key=itemgetter(0)))
+            for spool in run:
+                os.remove(spool)
+            merged.append(path)
+        spools = merged
+    return heapq.merge(*map(read_spool, spools), key=itemgetter(0))
+
+
+def _passthrough(data, timestamp=None):
+    """Return data encoded by a worker as it is."""
+    # pylint: disable=unused-argument
+    return data
+
+
+class Progress():
+    """Count finished shards and print the throughput to stream."""
+
+    def __init__(self, shards, total_bytes, stream=None):
+        """Initialize variables."""
+        self.shards = shards
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.done = 0
+        self.frames = 0
+        self.invalid = 0
+        self.bytes = 0
+        self.started = perf_counter()
+
+    def update(self, stats):
+        """Add the counters of a finished shard and print the progress."""
+        self.done += 1
+        self.frames += stats['frames']
+        self.invalid += stats['invalid']
+        self.bytes += stats['bytes']
+        if self.stream is None:
+            return
+        elapsed = perf_counter() - self.started
+        print('%d/%d shards, %.0f%%, %d frames, %.0f frames/s, %.1f MB/s'
+              % (self.done, self.shards,
+                 100.0 * self.bytes / self.total_bytes
+                 if self.total_bytes else 100.0,
+                 self.frames, self.frames / elapsed if elapsed else 0,
+                 self.bytes / elapsed / 1e6 if elapsed else 0),
+              file=self.stream)
+
+    def stats(self):
+        """Return the counters as a dict."""
+        elapsed = perf_counter() - self.started
+        return {
+            'shards': self.shards,
+            'frames': self.frames,
+            'invalid': self.invalid,
+            'input_bytes': self.bytes,
+            'seconds': elapsed,
+            'frames_per_second': self.frames / elapsed if elapsed else 0.0,
+        }
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def ingest(paths, output, output_format='json', workers=None,
+           chunk_bytes=CHUNK_BYTES, progress=True):
+    """Decode captures in a process pool and write them to output.
+
+    Readings are written in timestamp order, encoded in output_format,
+    and frames with the same timestamp keep the order of the captures.
+    Returns the counters.
+    """
+    shards = plan(paths, chunk_bytes)
+    total_bytes = sum(os.path.getsize(path) for path in set(paths))
+    tracker = Progress(len(shards), total_bytes,
+                       sys.stderr if progress else None)
+    spools = [None] * len(shards)
+    with tempfile.TemporaryDirectory(prefix='han_ingest') as directory:
+        tasks = [(index, shard, output_format, directory)
+                 for index, shard in enumerate(shards)]
+        with multiprocessing.Pool(workers) as pool:
+            for index, spool, stats in pool.imap_unordered(ingest_shard,
+                                                           tasks):
+                spools[index] = spool
+                tracker.update(stats)
+        merged = merge_spools([spool for spool in spools
+                               if spool is not None], directory)
+        with han_sinks.BatchWriter(output, _passthrough,
+                                   max_seconds=0) as writer:
+            for timestamp, data in merged:
+                writer.write(data, timestamp)
+    stats = tracker.stats()
+    stats.update(writer.stats())
+    stats['seconds'] = perf_counter() - tracker.started
+    return stats
+
+
+def main(argv=None):
+    """Decode capture files on every core into one output."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes, by default one per core')
+    parser.add_argument('--chunk-bytes', type=int, default=CHUNK_BYTES,
+                        help='largest shard of a capture file')
+    parser.add_argument('--format', choices=sorted(han_sinks.ENCODERS),
+                        default='json')
+    parser.add_argument('--output', default='-')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only print the totals')
+    args = parser.parse_args(argv)
+    # Rejected frames are counted, not logged one by one.
+    logging.getLogger(han_kamstrup.__name__).setLevel(logging.ERROR)
+    stats = ingest(args.paths, han_sinks.open_output(args.output),
+                   args.format, args.workers, args.chunk_bytes,
+                   not args.quiet)
+    print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
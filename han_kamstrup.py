@@ -4,102 +4,250 @@ Module that reads data from an Mbus serial adapter.
 It decodes the incoming data and output json formatted dict.
 """
 
+import asyncio
 import datetime
 import logging
-from time import sleep
+from time import perf_counter
+import han_crc
 import han_decode
+import han_frame
+import han_metrics
 import serial
-from crccheck.crc import CrcX25
 
 BAUDRATE = 2400
 DATA_FLAG = [230, 231, 0, 15]
 FRAME_FLAG = b'\x7e'
 SERIAL_PORT = '/dev/ttyUSB1'
-TIMEOUT = 0
+TIMEOUT = 1
+READ_SIZE = 1024
+QUEUE_SIZE = 100
+
+INVALID_SIZE = 'size'
+INVALID_FRAME_FLAG = 'frame_flag'
+INVALID_HEADER_CRC = 'header_crc'
+INVALID_FRAME_CRC = 'frame_crc'
+INVALID_DATA_FLAG = 'data_flag'
+INVALID_LENGTH = 'length'
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def open_serial(port=SERIAL_PORT, timeout=TIMEOUT):
+    """Open the Mbus serial adapter."""
+    return serial.Serial(
+        port=port,
+        baudrate=BAUDRATE,
+        parity=serial.PARITY_NONE,
+        stopbits=serial.STOPBITS_ONE,
+        bytesize=serial.EIGHTBITS,
+        timeout=timeout)
+
+
+def check_frame(data):
+    """Test the incoming data for validity.
+
+    Returns None for a valid frame, or the INVALID_* reason it was
+    rejected for.
+    """
+    started = perf_counter()
+    reason = _check_frame(data)
+    han_metrics.STAGE_SECONDS.observe('validate',
+                                      value=perf_counter() - started)
+    if reason is not None:
+        han_metrics.REJECTED.inc(reason)
+    return reason
+
+
+def _check_frame(data):
+    """Return the reason data is not a valid frame, or None."""
+    # pylint: disable=too-many-return-statements
+    if len(data) > 302 or len(data) < 180:
+        _LOGGER.warning('Invalid packet size %s', len(data))
+        return INVALID_SIZE
+
+    if not data[0] and data[-1] == FRAME_FLAG:
+        _LOGGER.warning("%s Recieved %s bytes of %s data",
+                        datetime.datetime.now().isoformat(),
+                        len(data), False)
+        return INVALID_FRAME_FLAG
+
+    # Both checksums are taken from one bit reversed copy of the frame.
+    reflected = memoryview(han_crc.reflect(data))
+    header_checksum = han_crc.crc_x25_reflected(reflected[1:6])
+    read_header_checksum = (data[7] << 8 | data[6])
+
+    if header_checksum != read_header_checksum:
+        _LOGGER.warning('Invalid header CRC check')
+        return INVALID_HEADER_CRC
+
+    frame_checksum = han_crc.crc_x25_reflected(reflected[1:-3])
+    read_frame_checksum = (data[-2] << 8 | data[-3])
+
+    if frame_checksum != read_frame_checksum:
+        _LOGGER.warning('Invalid frame CRC check')
+        return INVALID_FRAME_CRC
+
+    if bytes(data[8:12]) != bytes(DATA_FLAG):
+        _LOGGER.warning('Data does not start with %s: %s',
+                        DATA_FLAG, list(data[8:12]))
+        return INVALID_DATA_FLAG
+
+    packet_size = len(data)
+    read_packet_size = ((data[1] & 0x0F) << 8 | data[2]) + 2
+
+    if packet_size != read_packet_size:
+        _LOGGER.warning(
+            'Packet size does not match read packet size: %s : %s',
+            packet_size, read_packet_size)
+        return INVALID_LENGTH
+    return None
+
+
 class HanPowermeter():
     """The HAN serial reader class."""
 
-    def __init__(self):
+    def __init__(self, port=SERIAL_PORT):
         """Initialize variables."""
-        self.ser = serial.Serial(
-            port=SERIAL_PORT,
-            baudrate=BAUDRATE,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            bytesize=serial.EIGHTBITS,
-            timeout=TIMEOUT)
+        self.ser = open_serial(port)
+        self.framer = han_frame.HdlcFramer()
         self.han_data = {}
         self.valid_data = True
 
     def test_valid_data(self, data):
         """Test the incoming data for validity."""
-        # pylint: disable=too-many-return-statements
-        self.valid_data = True
-        if len(data) > 302 or len(data) < 180:
-            _LOGGER.warning('Invalid packet size %s', len(data))
-            self.valid_data = False
-            return self.valid_data
-
-        if not data[0] and data[-1] == FRAME_FLAG:
-            _LOGGER.warning("%s Recieved %s bytes of %s data",
-                            datetime.datetime.now().isoformat(),
-                            len(data), False)
-            self.valid_data = False
-            return self.valid_data
-
-        header_checksum = CrcX25.calc(bytes(data[1:6]))
-        read_header_checksum = (data[7] << 8 | data[6])
-
-        if header_checksum != read_header_checksum:
-            _LOGGER.warning('Invalid header CRC check')
-            self.valid_data = False
-            return self.valid_data
-
-        frame_checksum = CrcX25.calc(bytes(data[1:-3]))
-        read_frame_checksum = (data[-2] << 8 | data[-3])
-
-        if frame_checksum != read_frame_checksum:
-            _LOGGER.warning('Invalid frame CRC check')
-            self.valid_data = False
-            return self.valid_data
-
-        if data[8:12] != DATA_FLAG:
-            _LOGGER.warning('Data does not start with %s: %s',
-                            DATA_FLAG, data[8:12])
-            self.valid_data = False
-            return self.valid_data
-
-        packet_size = len(data)
-        read_packet_size = ((data[1] & 0x0F) << 8 | data[2]) + 2
-
-        if packet_size != read_packet_size:
-            _LOGGER.warning(
-                'Packet size does not match read packet size: %s : %s',
-                packet_size, read_packet_size)
-            self.valid_data = False
-            return self.valid_data
+        self.valid_data = check_frame(data) is None
         return self.valid_data
 
     def read_bytes(self):
-        """Read the raw data from serial port."""
-        byte_counter = 0
-        bytelist = []
+        """Read the next frame from serial port.
+
+        The frame is a view into the framer buffer and is only valid
+        until the next call.
+        """
         while True:
-            data = self.ser.read()
-            if data:
-                bytelist.extend(data)
-                if data == FRAME_FLAG and byte_counter > 1:
-                    return bytelist
-                byte_counter = byte_counter + 1
-            else:
-                sleep(2.5)
+            frame = self.framer.next_frame()
+            if frame is not None:
+                han_metrics.STAGE_SECONDS.observe(
+                    'read', value=self.framer.read_seconds)
+                return frame
+            # Block for the first byte, then take everything waiting.
+            waiting = min(self.ser.in_waiting, READ_SIZE)
+            self.framer.feed(self.ser.read(waiting or 1))
+
+
+class AsyncHanPowermeter():
+    """The HAN serial reader for asyncio.
+
+    The port is read from the event loop with add_reader, so one loop can
+    serve many meters without a thread per port:
+
+        async with AsyncHanPowermeter('/dev/ttyUSB0') as meter:
+            async for frame in meter.frames():
+                reading = han_decode.decode_frame(frame)
+
+    The port is closed when the iteration ends, also when the consumer
+    leaves the loop, and on leaving the context.
+    """
+
+    def __init__(self, port=SERIAL_PORT, queue_size=QUEUE_SIZE):
+        """Initialize variables."""
+        self.port = port
+        self.ser = None
+        self.framer = han_frame.HdlcFramer()
+        self._queue_size = queue_size
+        self._queue = None
+        self._loop = None
+
+    def open(self):
+        """Open the port and start reading it from the running loop.
+
+        Must be called from a coroutine, so the reader is added to the
+        loop that runs it.
+        """
+        if self.ser is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self.ser = open_serial(self.port, timeout=0)
+        self._loop.add_reader(self.ser.fileno(), self._read_ready)
+
+    def close(self):
+        """Stop reading and close the port."""
+        if self.ser is None:
+            return
+        self._loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+        self.ser = None
+        self._put(None)
+
+    async def __aenter__(self):
+        """Open the port."""
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Close the port."""
+        self.close()
+
+    def _put(self, frame):
+        """Queue a frame, dropping the oldest one if the queue is full."""
+        if self._queue.full():
+            _LOGGER.warning('%s: consumer too slow, dropping frame',
+                            self.port)
+            self._queue.get_nowait()
+        self._queue.put_nowait(frame)
+
+    def _read_ready(self):
+        """Read what is waiting on the port and queue complete frames."""
+        try:
+            data = self.ser.read(min(self.ser.in_waiting, READ_SIZE) or 1)
+        except serial.SerialException as err:
+            _LOGGER.error('%s: %s', self.port, err)
+            self.close()
+            return
+        self.framer.feed(data)
+        for frame in self.framer:
+            han_metrics.STAGE_SECONDS.observe(
+                'read', value=self.framer.read_seconds)
+            # The framer reuses its buffer, so queued frames are copied.
+            self._put(bytes(frame))
+
+    async def frames(self, validate=True):
+        """Iterate over the frames read from the port.
+
+        Invalid frames are skipped unless validate is False. Iteration
+        ends when the port is closed.
+        """
+        self.open()
+        try:
+            while True:
+                frame = await self._queue.get()
+                if frame is None:
+                    return
+                if validate and check_frame(frame) is not None:
+                    continue
+                yield frame
+        finally:
+            self.close()
+
+    async def readings(self):
+        """Iterate over the decoded readings from the port."""
+        frames = self.frames()
+        try:
+            async for frame in frames:
+                try:
+                    yield han_decode.decode_frame(frame)
+                except ValueError as err:
+                    _LOGGER.warning('Could not decode frame: %s', err)
+        finally:
+            await frames.aclose()
 
 
 if __name__ == '__main__':
+    try:
+        han_metrics.start_http_server()
+    except OSError as err:
+        _LOGGER.warning('Metrics not served: %s', err)
     APP = HanPowermeter()
     HAN_DATA = {}
 
@@ -108,7 +256,10 @@ if __name__ == '__main__':
             RAW_BYTES = APP.read_bytes()
             if APP.test_valid_data(RAW_BYTES):
                 PROCESSED_DATA = han_decode.parse_data(HAN_DATA, RAW_BYTES)
-                print(PROCESSED_DATA)
+                with han_metrics.STAGE_SECONDS.time('emit'):
+                    print(PROCESSED_DATA)
+        except ValueError as err:
+            _LOGGER.warning('Could not decode frame: %s', err)
         except KeyboardInterrupt:
             _LOGGER.error("Killed process on user signal")
             APP.ser.close()
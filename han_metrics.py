@@ -0,0 +1,224 @@
+"""
+Metrics for han_kamstrup.
+
+Counters and latency histograms for each stage of the read, validate,
+decode and emit path. They are kept in plain Python objects, cheap
+enough to leave on, and are read with snapshot() or served in the
+Prometheus text format by start_http_server().
+
+    han_frames_total{list_type}          decoded frames
+    han_frames_rejected_total{reason}    frames rejected by check_frame
+    han_frames_dropped_total{queue}      frames dropped by a full queue
+    han_stage_seconds{stage}             time spent in read, validate,
+                                         decode and emit
+"""
+
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import perf_counter
+
+METRICS_PORT = 9464
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from 10 us for decoding up to 5 s for reading a frame.
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _labels(names, values):
+    """Format label names and values for the text format."""
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in zip(names, values))
+
+
+class Counter():
+    """A counter per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        """Initialize variables."""
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        """Increase the counter of the given label values."""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        """Return the counters by label values."""
+        return self.values.copy()
+
+    def render(self):
+        """Return the counters in the text format."""
+        # Copied first, as other threads may add labels while rendering.
+        return ['%s%s %s' % (self.name, _labels(self.labels, labels), value)
+                for labels, value in sorted(self.values.copy().items())]
+
+
+class _HistogramValues():
+    """Bucket counts, sum and count of one histogram."""
+
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        """Initialize variables."""
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram():
+    """A histogram per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        """Initialize variables."""
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, *labels, value):
+        """Add a value to the histogram of the given label values."""
+        values = self.values.get(labels)
+        if values is None:
+            values = self.values[labels] = _HistogramValues(self.buckets)
+        values.counts[bisect_left(self.buckets, value)] += 1
+        values.sum += value
+        values.count += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the time spent in a with block."""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=perf_counter() - started)
+
+    def snapshot(self):
+        """Return count, sum and cumulative buckets by label values."""
+        result = {}
+        for labels, values in self.values.copy().items():
+            cumulative, total = [], 0
+            for count in values.counts[:-1]:
+                total += count
+                cumulative.append(total)
+            result[labels] = {
+                'count': values.count,
+                'sum': values.sum,
+                'buckets': dict(zip(self.buckets, cumulative)),
+            }
+        return result
+
+    def render(self):
+        """Return the histograms in the text format."""
+        lines = []
+        label_names = self.labels + ('le',)
+        for labels, values in sorted(self.values.copy().items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values.counts):
+                total += count
+                lines.append('%s_bucket%s %s' % (
+                    self.name, _labels(label_names, labels + (bound,)),
+                    total))
+            lines.append('%s_sum%s %s' % (
+                self.name, _labels(self.labels, labels), values.sum))
+            lines.append('%s_count%s %s' % (
+                self.name, _labels(self.labels, labels), values.count))
+        return lines
+
+
+class Registry():
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        """Initialize variables."""
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """Return the values of every metric by name."""
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FRAMES = REGISTRY.register(Counter(
+    'han_frames_total', 'Decoded frames by list type.', ('list_type',)))
+REJECTED = REGISTRY.register(Counter(
+    'han_frames_rejected_total', 'Frames rejected by reason.', ('reason',)))
+DROPPED = REGISTRY.register(Counter(
+    'han_frames_dropped_total', 'Frames dropped by a full queue.', ('queue',)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'han_stage_seconds', 'Time spent per frame in each stage.', ('stage',)))
+
+
+def snapshot():
+    """Return the values of the default metrics."""
+    return REGISTRY.snapshot()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread."""
+
+    daemon_threads = True
+
+
+def start_http_server(port=METRICS_PORT, addr='127.0.0.1',
+                      registry=REGISTRY):
+    """Serve the metrics on http://addr:port/metrics from a thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Return the rendered metrics."""
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Handle a GET request."""
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            """Log requests at debug level only."""
+            _LOGGER.debug(*args)
+
+    server = _ThreadingHTTPServer((addr, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
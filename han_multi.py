@@ -0,0 +1,206 @@
+"""
+Multi meter reader for han_kamstrup.
+
+Reads many Mbus serial adapters from one process. The ports are opened
+non-blocking and multiplexed with selectors (epoll on Linux), so a single
+thread serves every meter. Each decoded frame is tagged with the port it
+came from, and counters are kept per port.
+
+    python han_multi.py /dev/ttyUSB0 /dev/ttyUSB1 ...
+"""
+
+import json
+import logging
+import selectors
+import sys
+from time import perf_counter
+import han_decode
+import han_frame
+import han_kamstrup
+import han_metrics
+import serial
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PortStats():
+    """Counters for one port."""
+
+    def __init__(self):
+        """Initialize variables."""
+        self.bytes = 0
+        self.frames = 0
+        self.rejects = {}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def crc_failures(self):
+        """Return the number of frames rejected for a bad CRC."""
+        return (self.rejects.get(han_kamstrup.INVALID_HEADER_CRC, 0) +
+                self.rejects.get(han_kamstrup.INVALID_FRAME_CRC, 0))
+
+    @property
+    def size_rejects(self):
+        """Return the number of frames rejected for their size."""
+        return (self.rejects.get(han_kamstrup.INVALID_SIZE, 0) +
+                self.rejects.get(han_kamstrup.INVALID_LENGTH, 0))
+
+    @property
+    def latency_mean(self):
+        """Return the mean time from first byte read to validated frame."""
+        if not self.frames:
+            return 0.0
+        return self.latency_total / self.frames
+
+    def as_dict(self):
+        """Return the counters as a dict."""
+        return {
+            'bytes': self.bytes,
+            'frames': self.frames,
+            'crc_failures': self.crc_failures,
+            'size_rejects': self.size_rejects,
+            'rejects': dict(self.rejects),
+            'latency_mean': self.latency_mean,
+            'latency_max': self.latency_max,
+        }
+
+
+class MeterPort():
+    """One serial port read by the MultiMeterReader."""
+
+    def __init__(self, port, source=None):
+        """Initialize variables."""
+        self.port = port
+        self.source = source or port
+        self.ser = han_kamstrup.open_serial(port, timeout=0)
+        self.framer = han_frame.HdlcFramer()
+        self.stats = PortStats()
+        self.han_data = {'source': self.source}
+
+    def fileno(self):
+        """Return the file descriptor of the port."""
+        return self.ser.fileno()
+
+    def read(self, validate=True):
+        """Read what is waiting on the port and return the valid frames.
+
+        All frames are returned if validate is False. The frames are views
+        into the framer buffer and are only valid until the next read.
+        """
+        data = self.ser.read(
+            min(self.ser.in_waiting, han_kamstrup.READ_SIZE) or 1)
+        self.stats.bytes += len(data)
+        self.framer.feed(data)
+        frames = []
+        for frame in self.framer:
+            started = perf_counter() - self.framer.read_seconds
+            han_metrics.STAGE_SECONDS.observe(
+                'read', value=self.framer.read_seconds)
+            reason = han_kamstrup.check_frame(frame) if validate else None
+            if reason is not None:
+                self.stats.rejects[reason] = \
+                    self.stats.rejects.get(reason, 0) + 1
+                continue
+            latency = perf_counter() - started
+            self.stats.frames += 1
+            self.stats.latency_total += latency
+            self.stats.latency_max = max(self.stats.latency_max, latency)
+            frames.append(frame)
+        return frames
+
+    def close(self):
+        """Close the port."""
+        self.ser.close()
+
+
+class MultiMeterReader():
+    """Read frames from many ports in one thread."""
+
+    def __init__(self, ports=()):
+        """Initialize variables."""
+        self.selector = selectors.DefaultSelector()
+        self.ports = {}
+        for port in ports:
+            self.add_port(port)
+
+    def add_port(self, port, source=None):
+        """Open a port and start reading it."""
+        meter = MeterPort(port, source)
+        self.selector.register(meter, selectors.EVENT_READ)
+        self.ports[meter.source] = meter
+        return meter
+
+    def remove_port(self, source):
+        """Stop reading a port and close it."""
+        meter = self.ports.pop(source)
+        self.selector.unregister(meter)
+        meter.close()
+
+    def stats(self):
+        """Return the counters of every port by source."""
+        return {source: meter.stats for source, meter in self.ports.items()}
+
+    def frames(self, timeout=None, validate=True):
+        """Iterate over (MeterPort, frame) for valid frames on all ports.
+
+        Invalid frames are included if validate is False. Stops when no
+        port is left, or after timeout seconds without data.
+        """
+        while self.ports:
+            events = self.selector.select(timeout)
+            if not events:
+                return
+            for key, _ in events:
+                meter = key.fileobj
+                try:
+                    frames = meter.read(validate)
+                except serial.SerialException as err:
+                    _LOGGER.error('%s: %s', meter.source, err)
+                    self.remove_port(meter.source)
+                    continue
+                for frame in frames:
+                    yield meter, frame
+
+    def readings(self, timeout=None):
+        """Iterate over (source, HanReading) for all ports."""
+        for meter, frame in self.frames(timeout):
+            try:
+                yield meter.source, han_decode.decode_frame(frame)
+            except ValueError as err:
+                _LOGGER.warning('%s: could not decode frame: %s',
+                                meter.source, err)
+
+    def close(self):
+        """Close all ports."""
+        for source in list(self.ports):
+            self.remove_port(source)
+        self.selector.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    try:
+        han_metrics.start_http_server()
+    except OSError as err:
+        _LOGGER.warning('Metrics not served: %s', err)
+    APP = MultiMeterReader(sys.argv[1:] or [han_kamstrup.SERIAL_PORT])
+
+    try:
+        for METER, RAW_BYTES in APP.frames():
+            try:
+                PROCESSED_DATA = han_decode.parse_data(METER.han_data,
+                                                       RAW_BYTES)
+            except ValueError as err:
+                _LOGGER.warning('%s: could not decode frame: %s',
+                                METER.source, err)
+                continue
+            with han_metrics.STAGE_SECONDS.time('emit'):
+                print(PROCESSED_DATA)
+    except KeyboardInterrupt:
+        _LOGGER.error("Killed process on user signal")
+    finally:
+        print(json.dumps({source: stats.as_dict()
+                          for source, stats in APP.stats().items()}),
+              file=sys.stderr)
+        APP.close()
@@ -0,0 +1,314 @@
+"""
+Staged reader pipeline for han_kamstrup.
+
+The serial port is read in its own thread, so a slow consumer (a blocked
+stdout, a slow network sink, a GC pause) does not leave bytes waiting in
+the adapter until frames are lost. Frames go through bounded queues:
+
+    read -> [frames] -> decode -> [output] -> emit
+
+When a queue is full its policy decides what happens: drop-oldest drops
+the oldest item to make room, drop-newest drops the new item, and block
+waits for room. Dropped items are counted per queue, and in the
+han_frames_dropped_total metric. With the default drop-oldest, the read
+stage never waits on the stages after it.
+
+    python han_pipeline.py [port] [--policy drop-oldest|drop-newest|block]
+        [--queue-size N]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+from collections import deque
+from time import perf_counter, time
+import han_decode
+import han_kamstrup
+import han_metrics
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+QUEUE_SIZE = 100
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Closed(Exception):
+    """Raised by BoundedQueue.get when the queue is closed and empty."""
+
+
+class BoundedQueue():
+    """A thread safe FIFO of at most maxsize items, with a full policy."""
+
+    def __init__(self, name, maxsize=QUEUE_SIZE, policy=DROP_OLDEST):
+        """Initialize variables."""
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %s' % policy)
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.put_count = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self):
+        """Return the number of queued items."""
+        return len(self.items)
+
+    def put(self, item):
+        """Queue an item. Returns False if an item was dropped."""
+        with self._lock:
+            if self.closed:
+                raise Closed(self.name)
+            kept = True
+            if len(self.items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self._drop()
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self._drop()
+                    kept = False
+                else:
+                    while len(self.items) >= self.maxsize and \
+                            not self.closed:
+                        self._not_full.wait()
+                    if self.closed:
+                        raise Closed(self.name)
+            self.items.append(item)
+            self.put_count += 1
+            self.high_water = max(self.high_water, len(self.items))
+            self._not_empty.notify()
+            return kept
+
+    def _drop(self):
+        """Count a dropped item."""
+        self.dropped += 1
+        han_metrics.DROPPED.inc(self.name)
+
+    def get(self, timeout=None):
+        """Return the oldest item, waiting for one.
+
+        Raises Closed when the queue is closed and empty, or returns None
+        after timeout seconds without an item.
+        """
+        with self._lock:
+            while not self.items:
+                if self.closed:
+                    raise Closed(self.name)
+                if not self._not_empty.wait(timeout) and timeout is not None:
+                    return None
+            item = self.items.popleft()
+            self._not_full.notify()
+            return item
+
+    def close(self):
+        """Stop taking items. Queued items can still be taken with get."""
+        with self._lock:
+            self.closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def stats(self):
+        """Return the counters as a dict."""
+        return {
+            'policy': self.policy,
+            'size': len(self.items),
+            'put': self.put_count,
+            'dropped': self.dropped,
+            'high_water': self.high_water,
+        }
+
+
+class Stage():
+    """A thread calling func on each item taken from inbox.
+
+    Results other than None are put in outbox, which is closed when the
+    inbox is closed and drained.
+    """
+
+    def __init__(self, name, func, inbox, outbox=None):
+        """Initialize variables."""
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, name=name,
+                                       daemon=True)
+
+    def run(self):
+        """Process items until the inbox is closed."""
+        try:
+            while True:
+                try:
+                    item = self.inbox.get()
+                except Closed:
+                    return
+                try:
+                    result = self.func(item)
+                except Exception:  # pylint: disable=broad-except
+                    self.errors += 1
+                    _LOGGER.exception('%s failed', self.name)
+                    continue
+                self.processed += 1
+                if result is not None and self.outbox is not None:
+                    self.outbox.put(result)
+        except Closed:
+            return
+        finally:
+            if self.outbox is not None:
+                self.outbox.close()
+
+    def stats(self):
+        """Return the counters as a dict."""
+        return {'processed': self.processed, 'errors': self.errors}
+
+
+class Pipeline():
+    """Read, decode and emit frames, each stage in its own thread.
+
+    source is called for each frame and should block until there is one.
+    It returns a bytes-like frame, which is copied before queueing, or
+    None at the end. decode is called with (received time, frame) and
+    returns what emit is called with, or None to skip it. By default
+    frames are validated and decoded with parse_data, and emit prints
+    the JSON.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, source, emit=print, decode=None,
+                 queue_size=QUEUE_SIZE, policy=DROP_OLDEST):
+        """Initialize variables."""
+        self.source = source
+        self.han_data = {}
+        self.frames = BoundedQueue('frames', queue_size, policy)
+        self.output = BoundedQueue('output', queue_size, policy)
+        self.read_count = 0
+        self._running = threading.Event()
+        self._reader = threading.Thread(target=self._read, name='read',
+                                        daemon=True)
+        self.stages = [
+            Stage('decode', decode or self.decode, self.frames, self.output),
+            Stage('emit', self._emit(emit), self.output),
+        ]
+
+    def decode(self, item):
+        """Validate and decode a frame to JSON, or return None."""
+        _, frame = item
+        if han_kamstrup.check_frame(frame) is not None:
+            return None
+        try:
+            return han_decode.parse_data(self.han_data, frame)
+        except ValueError as err:
+            _LOGGER.warning('Could not decode frame: %s', err)
+            return None
+
+    @staticmethod
+    def _emit(emit):
+        """Wrap emit in the emit stage timer."""
+        def timed(item):
+            with han_metrics.STAGE_SECONDS.time('emit'):
+                emit(item)
+        return timed
+
+    def _read(self):
+        """Read frames into the frames queue until stopped."""
+        try:
+            while self._running.is_set():
+                frame = self.source()
+                if frame is None:
+                    return
+                self.read_count += 1
+                self.frames.put((time(), bytes(frame)))
+        except Closed:
+            return
+        except Exception:  # pylint: disable=broad-except
+            # Once stopped, the source may fail as its port is closed.
+            if self._running.is_set():
+                _LOGGER.exception('Reading failed')
+        finally:
+            self.frames.close()
+
+    def start(self):
+        """Start every stage."""
+        self._running.set()
+        for stage in self.stages:
+            stage.thread.start()
+        self._reader.start()
+
+    def stop(self, timeout=None):
+        """Stop reading and let the other stages finish what is queued.
+
+        A source blocked in a read returns only with its next frame, or
+        when it fails as its port is closed, which is not logged.
+        """
+        self._running.clear()
+        self.frames.close()
+        for stage in self.stages:
+            stage.thread.join(timeout)
+
+    def join(self, timeout=None):
+        """Wait for the source to end and the queues to drain."""
+        self._reader.join(timeout)
+        for stage in self.stages:
+            stage.thread.join(timeout)
+
+    def stats(self):
+        """Return the counters of every queue and stage."""
+        return {
+            'read': self.read_count,
+            'queues': {queue.name: queue.stats()
+                       for queue in (self.frames, self.output)},
+            'stages': {stage.name: stage.stats() for stage in self.stages},
+        }
+
+
+def main(argv=None):
+    """Read a meter through the pipeline and print the JSON of each frame."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('port', nargs='?', default=han_kamstrup.SERIAL_PORT)
+    parser.add_argument('--policy', choices=POLICIES, default=DROP_OLDEST)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    args = parser.parse_args(argv)
+    try:
+        han_metrics.start_http_server()
+    except OSError as err:
+        _LOGGER.warning('Metrics not served: %s', err)
+    meter = han_kamstrup.HanPowermeter(args.port)
+
+    def emit(line):
+        print(line)
+        sys.stdout.flush()
+
+    pipeline = Pipeline(meter.read_bytes, emit, queue_size=args.queue_size,
+                        policy=args.policy)
+    started = perf_counter()
+    pipeline.start()
+    try:
+        pipeline.join()
+    except KeyboardInterrupt:
+        _LOGGER.error("Killed process on user signal")
+    finally:
+        pipeline.stop(timeout=1)
+        meter.ser.cancel_read()
+        meter.ser.close()
+        stats = pipeline.stats()
+        stats['seconds'] = perf_counter() - started
+        print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
@@ -0,0 +1,360 @@
+"""
+Virtual Kamstrup meters for han_kamstrup.
+
+Each virtual meter is a pseudo-terminal: readers open its port like the
+Mbus serial adapter, and frames made by han_synth are written to the
+other side. A meter sends a short list every interval seconds and a long
+list every long_every frames, paced at the baud rate like the real line.
+An interval or baud rate of 0 sends as fast as the reader takes the
+bytes. A fraction of the frames can be corrupted on purpose.
+
+The sequence number of each frame is sent in its invoke id, so a load
+test can match the frames it reads to the frames sent, and report frame
+loss and the latency from the last byte written to the frame decoded.
+
+    python han_sim.py [--meters N] [--interval S] [--baudrate B]
+        [--corrupt F] [--load-test S]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import struct
+import sys
+import threading
+import tty
+from time import perf_counter, sleep
+import han_crc
+import han_decode
+import han_kamstrup
+import han_multi
+import han_synth
+
+BAUDRATE = han_kamstrup.BAUDRATE
+# 8 data bits with a start and a stop bit.
+BITS_PER_BYTE = 10
+INTERVAL = 10
+# A long list every hour of 10 second lists.
+LONG_EVERY = 360
+# Frames made per list type, sent in turn with new sequence numbers.
+POOL_SIZE = 32
+SINGLE_PHASE = (han_decode.LIST_TYPE_SHORT_1PH,
+                han_decode.LIST_TYPE_LONG_1PH)
+# Longest sleep of the send loop, seconds.
+TICK = 0.01
+
+_INVOKE_ID = struct.Struct('>I')
+_CRC = struct.Struct('<H')
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def invoke_id(frame):
+    """Return the invoke id of a frame, the sequence number when sent."""
+    return _INVOKE_ID.unpack_from(frame, 12)[0]
+
+
+def with_invoke_id(frame, number):
+    """Return a copy of a valid frame with another invoke id."""
+    data = bytearray(frame)
+    _INVOKE_ID.pack_into(data, 12, number & 0xFFFFFFFF)
+    _CRC.pack_into(data, len(data) - 3, han_crc.crc_x25(data[1:-3]))
+    return bytes(data)
+
+
+class SimStats():
+    """Counters for one virtual meter."""
+
+    def __init__(self):
+        """Initialize variables."""
+        self.frames = 0
+        self.corrupted = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.dropped = 0
+
+    def as_dict(self):
+        """Return the counters as a dict."""
+        return {
+            'frames': self.frames,
+            'corrupted': self.corrupted,
+            'bytes': self.bytes,
+            'stalls': self.stalls,
+            'dropped': self.dropped,
+        }
+
+
+class VirtualMeter():
+    """A pseudo-terminal sending HAN frames.
+
+    three_phase picks the list types, or list_types gives them as (short,
+    long). With drop_on_full, a frame the reader has no room for is
+    dropped like on a serial line; otherwise the meter waits for room.
+    Frames with a sequence number and the time their last byte was
+    written are kept in sent, if track is set.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, interval=INTERVAL, baudrate=BAUDRATE,
+                 three_phase=True, list_types=None, long_every=LONG_EVERY,
+                 corrupt=0.0, drop_on_full=False, track=False, rng=None):
+        """Initialize variables."""
+        self.interval = interval
+        self.byte_rate = baudrate / BITS_PER_BYTE if baudrate else 0
+        if list_types is None:
+            list_types = (han_synth.THREE_PHASE if three_phase else
+                          SINGLE_PHASE)
+        self.list_types = tuple(list_types)
+        self.long_every = long_every
+        self.corrupt = corrupt
+        self.drop_on_full = drop_on_full
+        self.track = track
+        self.rng = rng or random.Random()
+        self.stats = SimStats()
+        self.sent = {}
+        self._pool = {list_type: [han_synth.random_frame(list_type, self.rng)
+                                  for _ in range(POOL_SIZE)]
+                      for list_type in set(self.list_types)}
+        self._sequence = 0
+        self._pending = None
+        self._written = 0
+        self._started = 0.0
+        self._next_frame = 0.0
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self._slave)
+
+    def _next(self):
+        """Return the next frame to send, and its sequence number."""
+        sequence = self._sequence
+        self._sequence += 1
+        short_list, long_list = self.list_types
+        list_type = (long_list if self.long_every and
+                     sequence % self.long_every == self.long_every - 1
+                     else short_list)
+        pool = self._pool[list_type]
+        frame = with_invoke_id(pool[sequence % len(pool)], sequence)
+        if self.corrupt and self.rng.random() < self.corrupt:
+            reason = self.rng.choice(han_synth.CORRUPTIONS)
+            self.stats.corrupted += 1
+            return han_synth.corrupt(frame, reason, self.rng), None
+        return frame, sequence
+
+    def pump(self, now):
+        """Write what is due by now and return when to call again."""
+        if self._pending is None:
+            if now < self._next_frame:
+                return self._next_frame
+            self._pending = self._next()
+            self._written = 0
+            self._started = now
+        frame, sequence = self._pending
+        remaining = len(frame) - self._written
+        if self.byte_rate:
+            due = int((now - self._started) * self.byte_rate) - self._written
+            if due <= 0:
+                return self._started + (self._written + 1) / self.byte_rate
+            remaining = min(remaining, due)
+        if self.track and sequence is not None and \
+                self._written + remaining == len(frame):
+            # Set before the last write, as the reader may get it first.
+            self.sent[sequence] = perf_counter()
+        try:
+            written = os.write(
+                self.master, frame[self._written:self._written + remaining])
+        except BlockingIOError:
+            self.stats.stalls += 1
+            if not self.drop_on_full:
+                return now + TICK
+            # A dropped frame is not counted as sent.
+            self.stats.dropped += 1
+            self.sent.pop(sequence, None)
+            return self._done(now)
+        self.stats.bytes += written
+        self._written += written
+        if self._written < len(frame):
+            return now
+        self.stats.frames += 1
+        return self._done(now)
+
+    def _done(self, now):
+        """End the pending frame and return when the next one is due."""
+        self._pending = None
+        self._next_frame = (self._started + self.interval if self.interval
+                            else now)
+        return self._next_frame
+
+    def close(self):
+        """Close both ends of the pseudo-terminal."""
+        os.close(self.master)
+        os.close(self._slave)
+
+
+class Simulator():
+    """Drive many virtual meters from one thread."""
+
+    def __init__(self, meters):
+        """Initialize variables."""
+        self.meters = list(meters)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ports(self):
+        """Return the port of each meter."""
+        return [meter.port for meter in self.meters]
+
+    def run(self):
+        """Send frames until stopped."""
+        while not self._stop.is_set():
+            now = perf_counter()
+            wake = now + TICK
+            for meter in self.meters:
+                wake = min(wake, meter.pump(now))
+            delay = wake - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+    def start(self):
+        """Send frames from a thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sending."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Stop sending and close every meter."""
+        self.stop()
+        for meter in self.meters:
+            meter.close()
+
+
+def _percentile(ordered, fraction):
+    """Return the value at fraction of an ordered list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def load_test(simulator, seconds, drain=1.0):
+    """Read the simulator's meters with han_multi for seconds.
+
+    Returns frames sent and read, frames lost, throughput and latency.
+    """
+    by_port = {meter.port: meter for meter in simulator.meters}
+    for meter in simulator.meters:
+        meter.track = True
+    reader = han_multi.MultiMeterReader(by_port)
+    latencies = []
+    received = decode_errors = 0
+    last = started = perf_counter()
+
+    def read(until, timeout):
+        nonlocal received, decode_errors, last
+        for port, frame in reader.frames(timeout):
+            sent = by_port[port.source].sent.pop(invoke_id(frame), None)
+            try:
+                han_decode.decode_frame(frame)
+            except ValueError:
+                decode_errors += 1
+                continue
+            last = perf_counter()
+            if sent is not None:
+                latencies.append(last - sent)
+            received += 1
+            if until is not None and last >= until:
+                return
+
+    simulator.start()
+    try:
+        deadline = started + seconds
+        while perf_counter() < deadline:
+            read(deadline, TICK)
+    finally:
+        simulator.stop()
+    read(None, drain)
+    elapsed = last - started
+    stats = {port.source: port.stats.as_dict()
+             for port in reader.ports.values()}
+    reader.close()
+
+    latencies.sort()
+    sent = sum(meter.stats.frames for meter in simulator.meters)
+    corrupted = sum(meter.stats.corrupted for meter in simulator.meters)
+    lost = sum(len(meter.sent) for meter in simulator.meters)
+    return {
+        'meters': len(simulator.meters),
+        'seconds': elapsed,
+        'sent': sent,
+        'corrupted': corrupted,
+        'dropped': sum(meter.stats.dropped for meter in simulator.meters),
+        'received': received,
+        'lost': lost,
+        'decode_errors': decode_errors,
+        'rejected': sum(sum(port['rejects'].values())
+                        for port in stats.values()),
+        'frames_per_second': received / elapsed if elapsed else 0.0,
+        'latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p99': _percentile(latencies, 0.99),
+        'latency_max': latencies[-1] if latencies else 0.0,
+    }
+
+
+def main(argv=None):
+    """Run virtual meters, or a load test against them."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--meters', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=INTERVAL,
+                        help='seconds between frames, 0 for no wait')
+    parser.add_argument('--baudrate', type=int, default=BAUDRATE,
+                        help='line speed, 0 for no pacing')
+    parser.add_argument('--single-phase', action='store_true')
+    parser.add_argument('--long-every', type=int, default=LONG_EVERY,
+                        help='frames per long list, 0 for none')
+    parser.add_argument('--corrupt', type=float, default=0.0,
+                        help='fraction of frames to corrupt')
+    parser.add_argument('--drop-on-full', action='store_true',
+                        help='drop frames the reader has no room for')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--load-test', type=float, metavar='SECONDS',
+                        help='read the meters with han_multi and report')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    simulator = Simulator(
+        VirtualMeter(args.interval, args.baudrate, not args.single_phase,
+                     long_every=args.long_every, corrupt=args.corrupt,
+                     drop_on_full=args.drop_on_full,
+                     rng=random.Random(rng.random()))
+        for _ in range(args.meters))
+    try:
+        if args.load_test:
+            # Rejected frames are counted, not logged one by one.
+            logging.getLogger(han_kamstrup.__name__).setLevel(logging.ERROR)
+            print(json.dumps(load_test(simulator, args.load_test), indent=1))
+            return
+        print(' '.join(simulator.ports))
+        sys.stdout.flush()
+        try:
+            simulator.run()
+        except KeyboardInterrupt:
+            pass
+        print(json.dumps([meter.stats.as_dict()
+                          for meter in simulator.meters]), file=sys.stderr)
+    finally:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
@@ -0,0 +1,536 @@
+"""
+Output sinks for han_kamstrup.
+
+Encoders turn decoded readings straight into bytes, without the JSON
+text of parse_data, and a BatchWriter collects the encoded readings and
+writes them in one call when the batch is full or old enough. Most
+fields of a reading (OBIS codes, meter serial and type) are the same in
+every frame of a meter, so they are encoded once per meter and only the
+measurements are encoded per frame:
+
+    json        one JSON object per line, as printed by han_kamstrup
+    msgpack     MessagePack maps, back to back
+    cbor        CBOR maps, back to back
+    influx      InfluxDB line protocol, tagged by meter serial
+
+MessagePack uses the msgpack package if it is installed. Otherwise, and
+for CBOR, maps are encoded here for the types of a reading, and plain
+dicts are passed to cbor2 if it is installed.
+Output goes to a file, stdout ('-'), a unix socket ('unix:/path') or a
+TCP or UDP socket ('tcp://host:port', 'udp://host:port'). Batches to a
+UDP socket are kept to DATAGRAM_BYTES, so a batch is one unfragmented
+datagram.
+
+    python han_sinks.py [--format F] [--output O] [--capture FILE] [port ...]
+"""
+
+import argparse
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+from functools import lru_cache
+from operator import itemgetter
+from time import perf_counter, time
+from urllib.parse import urlsplit
+import han_decode
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+BATCH_BYTES = 65536
+BATCH_SECONDS = 1.0
+# Largest UDP payload not fragmented on a 1500 byte Ethernet MTU.
+DATAGRAM_BYTES = 1472
+MEASUREMENT = 'han'
+
+_FLOAT = struct.Struct('>d')
+_FIELDS = han_decode.HanReading._fields
+
+# Fields that do not change between frames of a meter.
+_STATIC = frozenset(
+    name for name in _FIELDS if name.startswith('obis_') or name in (
+        'packet_size', 'list_type', 'meter_serial', 'meter_type',
+        'meter_type_str'))
+_STATIC_NAMES = tuple(name for name in _FIELDS if name in _STATIC)
+_DYNAMIC_NAMES = tuple(name for name in _FIELDS if name not in _STATIC)
+_static_values = itemgetter(*(_FIELDS.index(name) for name in _STATIC_NAMES))
+_dynamic_values = itemgetter(*(_FIELDS.index(name)
+                               for name in _DYNAMIC_NAMES))
+
+MAX_CACHED_METERS = 1024
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _pack_uint(prefix, value):
+    """Pack an unsigned int with the smallest of the four big-endian
+    sizes after a type byte, where prefix is the type byte of uint8.
+    """
+    if value < 0x100:
+        return bytes((prefix, value))
+    if value < 0x10000:
+        return bytes((prefix + 1,)) + value.to_bytes(2, 'big')
+    if value < 0x100000000:
+        return bytes((prefix + 2,)) + value.to_bytes(4, 'big')
+    return bytes((prefix + 3,)) + value.to_bytes(8, 'big')
+
+
+@lru_cache(maxsize=1024)
+def _msgpack_str(text):
+    """Pack a str, cached as keys and meter strings repeat."""
+    data = text.encode()
+    size = len(data)
+    if size < 32:
+        return bytes((0xA0 | size,)) + data
+    return _pack_uint(0xD9, size) + data
+
+
+def _msgpack_value(value):
+    """Pack a value of a reading as MessagePack."""
+    if value is None:
+        return b'\xc0'
+    if value is True:
+        return b'\xc3'
+    if value is False:
+        return b'\xc2'
+    if isinstance(value, int):
+        if 0 <= value < 0x80:
+            return bytes((value,))
+        if value >= 0:
+            return _pack_uint(0xCC, value)
+        if value >= -32:
+            return bytes((value & 0xFF,))
+        return b'\xd3' + value.to_bytes(8, 'big', signed=True)
+    if isinstance(value, float):
+        return b'\xcb' + _FLOAT.pack(value)
+    if isinstance(value, str):
+        return _msgpack_str(value)
+    raise TypeError('Can not pack %r' % (value,))
+
+
+def _cbor_head(major, value):
+    """Return the CBOR head of a major type with an argument."""
+    major <<= 5
+    if value < 24:
+        return bytes((major | value,))
+    return _pack_uint(major | 24, value)
+
+
+@lru_cache(maxsize=1024)
+def _cbor_str(text):
+    """Encode a text string, cached as keys and meter strings repeat."""
+    data = text.encode()
+    return _cbor_head(3, len(data)) + data
+
+
+def _cbor_value(value):
+    """Encode a value of a reading as CBOR."""
+    if value is None:
+        return b'\xf6'
+    if value is True:
+        return b'\xf5'
+    if value is False:
+        return b'\xf4'
+    if isinstance(value, int):
+        if value >= 0:
+            return _cbor_head(0, value)
+        return _cbor_head(1, -1 - value)
+    if isinstance(value, float):
+        return b'\xfb' + _FLOAT.pack(value)
+    if isinstance(value, str):
+        return _cbor_str(value)
+    raise TypeError('Can not encode %r' % (value,))
+
+
+def _msgpack_head(size):
+    """Return the MessagePack head of a map of size items."""
+    if size < 16:
+        return bytes((0x80 | size,))
+    return b'\xde' + size.to_bytes(2, 'big')
+
+
+def _cbor_map_head(size):
+    """Return the CBOR head of a map of size items."""
+    return _cbor_head(5, size)
+
+
+class MapEncoder():
+    """Encode readings as maps of field name to value.
+
+    head, key and value return the encoding of a map head, a key and a
+    value. The static fields of each meter are encoded once and kept.
+    Other objects than readings are passed to fallback if given.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, head, key, value, fallback=None):
+        """Initialize variables."""
+        self.head = head
+        self.key = key
+        self.value = value
+        self.fallback = fallback
+        self._keys = {name: key(name) for name in _FIELDS}
+        self._dynamic_keys = tuple(self._keys[name]
+                                   for name in _DYNAMIC_NAMES)
+        self._static = {}
+
+    def __call__(self, reading, timestamp=None):
+        """Encode a reading as one map."""
+        # pylint: disable=unused-argument
+        if isinstance(reading, han_decode.FrameView):
+            reading = reading.to_reading()
+        elif not isinstance(reading, han_decode.HanReading):
+            reading = dict(reading)
+            if self.fallback is not None:
+                return self.fallback(reading)
+            parts = [self.head(len(reading))]
+            for name, value in reading.items():
+                parts.append(self.key(str(name)))
+                parts.append(self.value(value))
+            return b''.join(parts)
+        static = _static_values(reading)
+        cached = self._static.get(static)
+        if cached is None:
+            if len(self._static) >= MAX_CACHED_METERS:
+                self._static.clear()
+            present = [(name, value) for name, value in
+                       zip(_STATIC_NAMES, static) if value is not None]
+            cached = self._static[static] = (
+                b''.join(self._keys[name] + self.value(value)
+                         for name, value in present), len(present))
+        parts = [None, cached[0]]
+        count = cached[1]
+        value = self.value
+        for key, item in zip(self._dynamic_keys, _dynamic_values(reading)):
+            if item is not None:
+                parts.append(key)
+                parts.append(value(item))
+                count += 1
+        parts[0] = self.head(count)
+        return b''.join(parts)
+
+
+class JsonEncoder():
+    """Encode readings as one JSON object per line.
+
+    The static fields of each meter are encoded once and kept.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        """Initialize variables."""
+        self._static = {}
+
+    def __call__(self, reading, timestamp=None):
+        """Encode a reading as a line of JSON."""
+        # pylint: disable=unused-argument
+        if isinstance(reading, han_decode.FrameView):
+            reading = reading.to_reading()
+        elif not isinstance(reading, han_decode.HanReading):
+            return json.dumps(dict(reading)).encode() + b'\n'
+        static = _static_values(reading)
+        cached = self._static.get(static)
+        if cached is None:
+            if len(self._static) >= MAX_CACHED_METERS:
+                self._static.clear()
+            cached = self._static[static] = json.dumps({
+                name: value for name, value in zip(_STATIC_NAMES, static)
+                if value is not None})[:-1]
+        dynamic = json.dumps({
+            name: value for name, value in
+            zip(_DYNAMIC_NAMES, _dynamic_values(reading))
+            if value is not None})
+        if len(dynamic) > 2:
+            return ('%s, %s\n' % (cached, dynamic[1:])).encode()
+        return (cached + '}\n').encode()
+
+
+def _escape_tag(value):
+    """Escape a tag value of the line protocol."""
+    return str(value).replace('\\', '\\\\').replace(',', '\\,') \
+        .replace('=', '\\=').replace(' ', '\\ ')
+
+
+class InfluxEncoder():
+    """Encode readings as InfluxDB line protocol.
+
+    The numbers that change between frames are fields, integers with the
+    i suffix. The tags name the meter, and the time is the receive time
+    in nanoseconds.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, measurement=MEASUREMENT,
+                 tags=('meter_serial', 'list_type')):
+        """Initialize variables."""
+        self.measurement = _escape_tag(measurement)
+        self.tags = tags
+        self._keys = {}
+
+    def _key(self, tags):
+        """Return the measurement and tags of a reading's tag values."""
+        key = self._keys.get(tags)
+        if key is None:
+            if len(self._keys) >= MAX_CACHED_METERS:
+                self._keys.clear()
+            key = self._keys[tags] = self.measurement + ''.join(
+                ',%s=%s' % (tag, _escape_tag(value))
+                for tag, value in zip(self.tags, tags) if value is not None)
+        return key
+
+    def __call__(self, reading, timestamp=None):
+        """Encode a reading as one line."""
+        if timestamp is None:
+            timestamp = time()
+        if isinstance(reading, han_decode.FrameView):
+            reading = reading.to_reading()
+        if isinstance(reading, han_decode.HanReading):
+            items = zip(_DYNAMIC_NAMES, _dynamic_values(reading))
+            key = self._key(tuple(getattr(reading, tag, None)
+                                  for tag in self.tags))
+        else:
+            items = reading.items()
+            key = self._key(tuple(reading.get(tag) for tag in self.tags))
+        fields = []
+        for name, value in items:
+            if isinstance(value, bool) or name in self.tags:
+                continue
+            if isinstance(value, int):
+                fields.append('%s=%di' % (name, value))
+            elif isinstance(value, float):
+                fields.append('%s=%r' % (name, value))
+        return ('%s %s %d\n' % (key, ','.join(fields),
+                                int(timestamp * 1e9))).encode()
+
+
+def _packb(reading, timestamp=None):
+    """Encode a reading with the msgpack package."""
+    # pylint: disable=unused-argument
+    if isinstance(reading, han_decode.FrameView):
+        reading = reading.to_reading()
+    if isinstance(reading, han_decode.HanReading):
+        reading = reading.as_dict()
+    return msgpack.packb(reading)
+
+
+ENCODERS = {
+    'json': JsonEncoder(),
+    # The C packer of msgpack is faster than the cached static fields.
+    'msgpack': (_packb if msgpack else
+                MapEncoder(_msgpack_head, _msgpack_str, _msgpack_value)),
+    'cbor': MapEncoder(_cbor_map_head, _cbor_str, _cbor_value,
+                       cbor2.dumps if cbor2 else None),
+    'influx': InfluxEncoder(),
+}
+
+
+class _SocketOutput():
+    """A socket written like a binary file.
+
+    max_bytes is the largest write of a datagram socket, or None.
+    """
+
+    def __init__(self, sock):
+        """Initialize variables."""
+        self.sock = sock
+        self.max_bytes = (DATAGRAM_BYTES if sock.type == socket.SOCK_DGRAM
+                          else None)
+
+    def write(self, data):
+        """Send all of data."""
+        if self.sock.type == socket.SOCK_DGRAM:
+            self.sock.send(data)
+        else:
+            self.sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        """Nothing is buffered."""
+
+    def close(self):
+        """Close the socket."""
+        self.sock.close()
+
+
+def open_output(target):
+    """Open an output by name: '-', 'unix:/path', 'tcp://host:port',
+    'udp://host:port' or a file path, appended to.
+
+    Files are not buffered, so each batch is one write.
+    """
+    if target == '-':
+        return sys.stdout.buffer
+    if target.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[len('unix:'):])
+        return _SocketOutput(sock)
+    url = urlsplit(target)
+    if url.scheme in ('tcp', 'udp'):
+        if url.scheme == 'tcp':
+            sock = socket.create_connection((url.hostname, url.port))
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((url.hostname, url.port))
+        return _SocketOutput(sock)
+    return open(target, 'ab', buffering=0)
+
+
+class BatchWriter():
+    """Encode readings into a buffer and write it in batches.
+
+    A batch is written before it would grow past max_bytes, or, from a
+    thread, when its first reading is max_seconds old. Only a single
+    reading larger than max_bytes makes a larger batch. An output with a
+    max_bytes of its own, such as a datagram socket, lowers max_bytes to
+    it.
+    """
+
+    def __init__(self, output, encoder=None, max_bytes=BATCH_BYTES,
+                 max_seconds=BATCH_SECONDS):
+        """Initialize variables."""
+        self.output = output
+        self.encoder = encoder or ENCODERS['json']
+        limit = getattr(output, 'max_bytes', None)
+        self.max_bytes = min(max_bytes, limit) if limit else max_bytes
+        self.max_seconds = max_seconds
+        self.readings = 0
+        self.batches = 0
+        self.bytes = 0
+        self._buffer = bytearray()
+        self._first = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if max_seconds:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def write(self, reading, timestamp=None):
+        """Encode a reading and add it to the batch."""
+        data = self.encoder(reading, timestamp)
+        with self._lock:
+            if len(self._buffer) + len(data) > self.max_bytes:
+                self._flush()
+            if not self._buffer:
+                self._first = perf_counter()
+            self._buffer += data
+            self.readings += 1
+
+    def flush(self):
+        """Write the batch now."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """Write the batch, holding the lock."""
+        if not self._buffer:
+            return
+        self.output.write(self._buffer)
+        self.output.flush()
+        self.batches += 1
+        self.bytes += len(self._buffer)
+        self._buffer = bytearray()
+        self._first = None
+
+    def _run(self):
+        """Write batches that are max_seconds old."""
+        while not self._stop.wait(self.max_seconds / 4):
+            with self._lock:
+                if self._first is not None and \
+                        perf_counter() - self._first >= self.max_seconds:
+                    try:
+                        self._flush()
+                    except OSError as err:
+                        _LOGGER.error('Write failed: %s', err)
+
+    def close(self):
+        """Write the last batch and close the output."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self.output is not sys.stdout.buffer:
+            self.output.close()
+
+    def stats(self):
+        """Return the counters as a dict."""
+        return {'readings': self.readings, 'batches': self.batches,
+                'bytes': self.bytes}
+
+    def __enter__(self):
+        """Return the writer."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close the writer."""
+        self.close()
+
+
+def _capture_readings(path):
+    """Yield (timestamp, reading) for the valid frames of a capture."""
+    # Imported here so the sinks do not need pyserial for a capture.
+    import han_capture  # pylint: disable=import-outside-toplevel
+    import han_kamstrup  # pylint: disable=import-outside-toplevel
+    with han_capture.CaptureReader(path) as reader:
+        for timestamp, _, frame in reader:
+            if han_kamstrup.check_frame(frame) is not None:
+                continue
+            try:
+                yield timestamp, han_decode.decode_frame(frame)
+            except ValueError as err:
+                _LOGGER.warning('Could not decode frame: %s', err)
+
+
+def _port_readings(ports):
+    """Yield (timestamp, reading) from serial ports until interrupted."""
+    import han_multi  # pylint: disable=import-outside-toplevel
+    reader = han_multi.MultiMeterReader(
+        ports or [han_multi.han_kamstrup.SERIAL_PORT])
+    try:
+        for _, reading in reader.readings():
+            yield time(), reading
+    finally:
+        reader.close()
+
+
+def main(argv=None):
+    """Write readings from ports or a capture to an output."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('ports', nargs='*')
+    parser.add_argument('--format', choices=sorted(ENCODERS), default='json')
+    parser.add_argument('--output', default='-')
+    parser.add_argument('--capture', help='read a capture file instead')
+    parser.add_argument('--batch-bytes', type=int, default=BATCH_BYTES)
+    parser.add_argument('--batch-seconds', type=float, default=BATCH_SECONDS)
+    args = parser.parse_args(argv)
+
+    readings = (_capture_readings(args.capture) if args.capture else
+                _port_readings(args.ports))
+    started = perf_counter()
+    with BatchWriter(open_output(args.output), ENCODERS[args.format],
+                     args.batch_bytes, args.batch_seconds) as writer:
+        try:
+            for timestamp, reading in readings:
+                writer.write(reading, timestamp)
+        except KeyboardInterrupt:
+            _LOGGER.error("Killed process on user signal")
+        except OSError as err:
+            _LOGGER.error('Write failed: %s', err)
+    stats = writer.stats()
+    stats['seconds'] = perf_counter() - started
+    print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
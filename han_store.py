@@ -0,0 +1,553 @@
+"""
+Time-series store for han_kamstrup.
+
+Keeps decoded readings on disk per meter as fixed-width binary records,
+appended to segment files:
+
+    <directory>/<meter>/raw/00000000.seg      time and 14 measurements
+    <directory>/<meter>/raw/index             sparse timestamp index
+    <directory>/<meter>/1m/...                1 minute rollups
+    <directory>/<meter>/1h/...                1 hour rollups
+
+A raw record is 64 bytes: the timestamp as a double and every
+measurement as an int32, scaled to hundredths where the meter sends
+them so. A 10 second list is about 200 MB per meter and year. Every
+INDEX_INTERVAL records the timestamp is added to the index, so a range
+query reads only the records of its range. Appended records are buffered
+and written by flush(), which opens the files only while writing, so a
+store of many meters holds no open files between flushes. Rollups hold
+the count, mean, min and max of each measurement per bucket. They are
+made by downsample(), from a thread with start(), and are what long
+ranges should be queried from.
+
+    python han_store.py record <directory> [port ...]
+    python han_store.py query <directory> <meter> [--start T] [--end T]
+        [--resolution raw|1m|1h]
+"""
+
+import argparse
+import csv
+import logging
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+from operator import truediv
+from time import time
+from urllib.parse import quote, unquote
+import han_history
+
+RAW = 'raw'
+MINUTE = '1m'
+HOUR = '1h'
+RESOLUTIONS = (RAW, MINUTE, HOUR)
+
+# Rollup resolution: (seconds per bucket, resolution it is made from)
+ROLLUPS = {
+    MINUTE: (60, RAW),
+    HOUR: (3600, MINUTE),
+}
+
+MEASUREMENTS = han_history.MEASUREMENTS
+
+# Measurements stored in hundredths, as the meter sends them.
+_SCALES = tuple(100 if name in han_history.ENERGIES or
+                name.startswith('current_') else 1
+                for name in MEASUREMENTS)
+
+MISSING = -2 ** 31
+
+SEGMENT_RECORDS = 65536
+INDEX_INTERVAL = 256
+# Buffered bytes of a series written at once, and records read at once.
+FLUSH_BYTES = 8192
+READ_RECORDS = 4096
+DOWNSAMPLE_INTERVAL = 60
+
+_INDEX_ENTRY = struct.Struct('<dQ')
+_NAN = float('nan')
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _raw_struct():
+    """Return the struct of a raw record: time and measurements."""
+    return struct.Struct('<d%di' % len(MEASUREMENTS))
+
+
+def _rollup_struct():
+    """Return the struct of a rollup record.
+
+    Time of the bucket, samples in it, and mean, min and max of each
+    measurement, padded to a multiple of 8 bytes.
+    """
+    return struct.Struct('<di%dix' % (3 * len(MEASUREMENTS)) + '3x')
+
+
+def _scale(value, scale):
+    """Return a measurement as a scaled int32, or MISSING."""
+    if value is None or value != value:
+        return MISSING
+    return int(round(value * scale))
+
+
+def _words(data, typecode):
+    """Return little-endian packed records as an array of typecode."""
+    words = array(typecode)
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def _unscale(values, scale):
+    """Return scaled int32 values as floats, with NaN for MISSING."""
+    missing = values.count(MISSING)
+    if missing == len(values):
+        return array('d', [_NAN]) * missing
+    if missing:
+        return array('d', [_NAN if value == MISSING else value / scale
+                           for value in values])
+    if scale == 1:
+        return array('d', values)
+    return array('d', map(truediv, values, repeat(scale)))
+
+
+class _Series():
+    """Fixed-width records in segment files, with a sparse time index.
+
+    Records must be appended in time order. They are buffered until
+    flush(), or until FLUSH_BYTES are buffered, and the files are only
+    open while they are written or read.
+    """
+
+    def __init__(self, directory, record):
+        """Initialize variables."""
+        self.directory = directory
+        self.record = record
+        self.count = 0
+        self.last_time = None
+        self._index_times = array('d')
+        self._index_numbers = array('Q')
+        self._index_path = os.path.join(directory, 'index')
+        # Records and index entries not yet written, from record written.
+        self._written = 0
+        self._pending = bytearray()
+        self._pending_index = bytearray()
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _path(self, segment):
+        """Return the path of a segment file."""
+        return os.path.join(self.directory, '%08d.seg' % segment)
+
+    def _open(self):
+        """Count the records on disk and load or rebuild the index."""
+        size = self.record.size
+        segments = sorted(int(name[:-4]) for name in
+                          os.listdir(self.directory) if name.endswith('.seg'))
+        for segment in segments:
+            path = self._path(segment)
+            length = os.path.getsize(path)
+            if length % size:
+                # A record cut short by a crash.
+                _LOGGER.warning('Truncating partial record in %s', path)
+                with open(path, 'r+b') as segment_file:
+                    segment_file.truncate(length - length % size)
+                length -= length % size
+            self.count = segment * SEGMENT_RECORDS + length // size
+        self._written = self.count
+        index_path = self._index_path
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as index_file:
+                for timestamp, number in _INDEX_ENTRY.iter_unpack(
+                        index_file.read()):
+                    if number >= self.count:
+                        break
+                    self._index_times.append(timestamp)
+                    self._index_numbers.append(number)
+        # Entries lost when the index was not written before a crash.
+        number = (self._index_numbers[-1] + INDEX_INTERVAL
+                  if self._index_numbers else 0)
+        with open(index_path, 'wb') as index_file:
+            for timestamp, indexed in zip(self._index_times,
+                                          self._index_numbers):
+                index_file.write(_INDEX_ENTRY.pack(timestamp, indexed))
+            while number < self.count:
+                timestamp = self._read(number, 1)[0][0]
+                self._index_times.append(timestamp)
+                self._index_numbers.append(number)
+                index_file.write(_INDEX_ENTRY.pack(timestamp, number))
+                number += INDEX_INTERVAL
+        if self.count:
+            self.last_time = self._read(self.count - 1, 1)[0][0]
+
+    def append(self, values):
+        """Append a record, a tuple starting with its timestamp."""
+        number = self.count
+        self._pending += self.record.pack(*values)
+        if number % INDEX_INTERVAL == 0:
+            self._index_times.append(values[0])
+            self._index_numbers.append(number)
+            self._pending_index += _INDEX_ENTRY.pack(values[0], number)
+        self.count += 1
+        self.last_time = values[0]
+        if len(self._pending) >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Write buffered records to disk."""
+        if not self._pending:
+            return
+        size = self.record.size
+        number = self._written
+        data = memoryview(self._pending)
+        while number < self.count:
+            segment, position = divmod(number, SEGMENT_RECORDS)
+            chunk = min(self.count - number, SEGMENT_RECORDS - position)
+            offset = (number - self._written) * size
+            with open(self._path(segment), 'ab') as segment_file:
+                segment_file.write(data[offset:offset + chunk * size])
+            number += chunk
+        data.release()
+        # Records first, so the index never points past them.
+        if self._pending_index:
+            with open(self._index_path, 'ab') as index_file:
+                index_file.write(self._pending_index)
+        self._written = self.count
+        self._pending = bytearray()
+        self._pending_index = bytearray()
+
+    def close(self):
+        """Write buffered records to disk."""
+        self.flush()
+
+    def _read_bytes(self, number, count):
+        """Return up to count packed records from record number on."""
+        chunks = []
+        size = self.record.size
+        while count > 0 and number < self.count:
+            segment, position = divmod(number, SEGMENT_RECORDS)
+            chunk = min(count, SEGMENT_RECORDS - position,
+                        self.count - number)
+            with open(self._path(segment), 'rb') as segment_file:
+                segment_file.seek(position * size)
+                chunks.append(segment_file.read(chunk * size))
+            number += chunk
+            count -= chunk
+        return b''.join(chunks)
+
+    def _read(self, number, count):
+        """Return up to count records from record number on."""
+        return list(self.record.iter_unpack(self._read_bytes(number, count)))
+
+    def _span(self, start, end):
+        """Return the record numbers bounding start <= time < end."""
+        number = 0
+        if start is not None:
+            # The last entry before start; every record before it is too.
+            entry = bisect_left(self._index_times, start) - 1
+            if entry >= 0:
+                number = self._index_numbers[entry]
+        stop = self.count
+        if end is not None:
+            entry = bisect_right(self._index_times, end)
+            if entry < len(self._index_numbers):
+                stop = self._index_numbers[entry]
+        return number, stop
+
+    def records(self, start=None, end=None, chunk=READ_RECORDS):
+        """Iterate over the records with start <= time < end.
+
+        Records are read chunk records at a time.
+        """
+        self.flush()
+        number, stop = self._span(start, end)
+        while number < stop:
+            count = min(chunk, stop - number)
+            for values in self.record.iter_unpack(
+                    self._read_bytes(number, count)):
+                if start is not None and values[0] < start:
+                    continue
+                if end is not None and values[0] >= end:
+                    return
+                yield values
+            number += count
+
+    def read_range(self, start=None, end=None):
+        """Return the packed records with start <= time < end."""
+        self.flush()
+        number, stop = self._span(start, end)
+        data = self._read_bytes(number, stop - number)
+        times = _words(data, 'd')[::self.record.size // 8]
+        first = 0 if start is None else bisect_left(times, start)
+        last = len(times) if end is None else bisect_left(times, end)
+        return data[first * self.record.size:last * self.record.size]
+
+
+class _Meter():
+    """The raw and rollup series of one meter."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, directory):
+        """Initialize variables."""
+        self.series = {RAW: _Series(os.path.join(directory, RAW),
+                                    _raw_struct())}
+        for resolution in ROLLUPS:
+            self.series[resolution] = _Series(
+                os.path.join(directory, resolution), _rollup_struct())
+
+
+def _rollup_rows(rows, seconds, resolution):
+    """Roll rows of a resolution up into buckets of seconds.
+
+    Yields a rollup record per bucket, holding only the rows of one
+    bucket at a time.
+    """
+    bucket_rows = []
+    bucket = None
+    for row in rows:
+        row_bucket = row[0] - row[0] % seconds
+        if row_bucket != bucket:
+            if bucket_rows:
+                yield _rollup(bucket, bucket_rows, resolution)
+            bucket, bucket_rows = row_bucket, []
+        bucket_rows.append(row)
+    if bucket_rows:
+        yield _rollup(bucket, bucket_rows, resolution)
+
+
+def _rollup(bucket, rows, resolution):
+    """Return the rollup record of the rows of one bucket."""
+    values = [bucket, 0]
+    measurements = len(MEASUREMENTS)
+    if resolution == RAW:
+        values[1] = len(rows)
+        for index in range(measurements):
+            samples = [row[1 + index] for row in rows
+                       if row[1 + index] != MISSING]
+            if samples:
+                values.extend((int(round(sum(samples) / len(samples))),
+                               min(samples), max(samples)))
+            else:
+                values.extend((MISSING, MISSING, MISSING))
+        return values
+    values[1] = sum(row[1] for row in rows)
+    for index in range(measurements):
+        total = count = 0
+        lows, highs = [], []
+        for row in rows:
+            mean, low, high = row[2 + 3 * index:5 + 3 * index]
+            if mean == MISSING:
+                continue
+            total += mean * row[1]
+            count += row[1]
+            lows.append(low)
+            highs.append(high)
+        if count:
+            values.extend((int(round(total / count)), min(lows), max(highs)))
+        else:
+            values.extend((MISSING, MISSING, MISSING))
+    return values
+
+
+class ReadingStore():
+    """Readings of many meters on disk, queried by meter and time range.
+
+        store = ReadingStore('/var/lib/han')
+        store.append(reading.meter_serial, reading)
+        store.start()
+        columns = store.query(serial, time() - 86400, resolution='1m')
+    """
+
+    def __init__(self, directory):
+        """Initialize variables."""
+        self.directory = directory
+        self._meters = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def meters(self):
+        """Return the meters in the store."""
+        return sorted(unquote(name) for name in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, name)))
+
+    def _meter(self, meter):
+        """Return the series of a meter, opening them if needed."""
+        series = self._meters.get(meter)
+        if series is None:
+            series = self._meters[meter] = _Meter(
+                os.path.join(self.directory, quote(str(meter), safe='')))
+        return series
+
+    def append(self, meter, reading, timestamp=None):
+        """Store a reading, such as a HanReading, of a meter.
+
+        Readings older than the last one of the meter are dropped and
+        False is returned.
+        """
+        if timestamp is None:
+            timestamp = time()
+        values = [timestamp]
+        for name, scale in zip(MEASUREMENTS, _SCALES):
+            values.append(_scale(getattr(reading, name, None), scale))
+        with self._lock:
+            series = self._meter(meter).series[RAW]
+            if series.last_time is not None and timestamp < series.last_time:
+                _LOGGER.warning('%s: dropping reading older than the last',
+                                meter)
+                return False
+            series.append(values)
+        return True
+
+    def flush(self):
+        """Write buffered records of every meter to disk."""
+        with self._lock:
+            for meter in self._meters.values():
+                for series in meter.series.values():
+                    series.flush()
+
+    def downsample(self, now=None):
+        """Add rollups for the buckets that ended before now."""
+        if now is None:
+            now = time()
+        added = 0
+        with self._lock:
+            for meter in self.meters():
+                series = self._meter(meter).series
+                for resolution, (seconds, source) in ROLLUPS.items():
+                    rollups = series[resolution]
+                    start = (rollups.last_time + seconds
+                             if rollups.last_time is not None else None)
+                    end = now - now % seconds
+                    rows = series[source].records(start, end)
+                    for values in _rollup_rows(rows, seconds, source):
+                        rollups.append(values)
+                        added += 1
+        return added
+
+    def query(self, meter, start=None, end=None, resolution=RAW,
+              measurements=MEASUREMENTS):
+        """Return the readings of a meter with start <= time < end.
+
+        Returns a dict of array('d') columns: time, and each measurement
+        with NaN where it is missing. Rollups also have count and the
+        <name>_min and <name>_max columns, with the mean in <name>.
+        """
+        with self._lock:
+            if meter not in self._meters and meter not in self.meters():
+                raise KeyError(meter)
+            series = self._meter(meter).series[resolution]
+            data = series.read_range(start, end)
+        # Records are read as columns by striding over their 4 byte words,
+        # the timestamp being the first two.
+        stride = series.record.size // 4
+        words = _words(data, 'i')
+        result = {'time': _words(data, 'd')[::stride // 2]}
+        if resolution == RAW:
+            for name in measurements:
+                index = MEASUREMENTS.index(name)
+                result[name] = _unscale(words[2 + index::stride],
+                                        _SCALES[index])
+            return result
+        result['count'] = array('d', words[2::stride])
+        for name in measurements:
+            index = MEASUREMENTS.index(name)
+            for part, suffix in enumerate(('', '_min', '_max')):
+                result[name + suffix] = _unscale(
+                    words[3 + 3 * index + part::stride], _SCALES[index])
+        return result
+
+    def start(self, interval=DOWNSAMPLE_INTERVAL):
+        """Flush and downsample every interval seconds from a thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        """Flush and downsample until stopped."""
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+                self.downsample()
+            except OSError as err:
+                _LOGGER.error('Downsampling failed: %s', err)
+
+    def close(self):
+        """Stop the thread and write what is buffered."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for meter in self._meters.values():
+                for series in meter.series.values():
+                    series.close()
+            self._meters.clear()
+
+    def __enter__(self):
+        """Return the store."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close the store."""
+        self.close()
+
+
+def record(directory, ports):
+    """Store readings from serial ports until interrupted."""
+    # Imported here so queries do not need pyserial.
+    import han_multi  # pylint: disable=import-outside-toplevel
+    reader = han_multi.MultiMeterReader(
+        ports or [han_multi.han_kamstrup.SERIAL_PORT])
+    with ReadingStore(directory) as store:
+        store.start()
+        try:
+            for _, reading in reader.readings():
+                store.append(reading.meter_serial, reading)
+        except KeyboardInterrupt:
+            _LOGGER.error("Killed process on user signal")
+        finally:
+            reader.close()
+            store.flush()
+            store.downsample()
+
+
+def main(argv=None):
+    """Record to or query a store."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    record_parser = commands.add_parser('record')
+    record_parser.add_argument('directory')
+    record_parser.add_argument('ports', nargs='*')
+    query_parser = commands.add_parser('query')
+    query_parser.add_argument('directory')
+    query_parser.add_argument('meter')
+    query_parser.add_argument('--start', type=float)
+    query_parser.add_argument('--end', type=float)
+    query_parser.add_argument('--resolution', choices=RESOLUTIONS,
+                              default=RAW)
+    args = parser.parse_args(argv)
+    if args.command == 'record':
+        record(args.directory, args.ports)
+    elif args.command == 'query':
+        with ReadingStore(args.directory) as store:
+            columns = store.query(args.meter, args.start, args.end,
+                                  args.resolution)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(zip(*columns.values()))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main()
@@ -0,0 +1,185 @@
+"""
+Synthetic Kamstrup HAN frames.
+
+Builds valid frames of every list type, with correct length field and
+header and frame CRCs, from given or random values. corrupt() makes
+invalid variants of a frame for each reason check_frame rejects one.
+"""
+
+import datetime
+import random
+import struct
+import han_crc
+import han_decode
+import han_kamstrup
+
+LIST_TYPES = (
+    han_decode.LIST_TYPE_SHORT_1PH,
+    han_decode.LIST_TYPE_LONG_1PH,
+    han_decode.LIST_TYPE_SHORT_3PH,
+    han_decode.LIST_TYPE_LONG_3PH,
+)
+
+THREE_PHASE = (han_decode.LIST_TYPE_SHORT_3PH, han_decode.LIST_TYPE_LONG_3PH)
+LONG_LIST = (han_decode.LIST_TYPE_LONG_1PH, han_decode.LIST_TYPE_LONG_3PH)
+
+LIST_VERSION = b'Kamstrup_V0001'
+METER_TYPE_1PH = b'6861111BN243101040'
+METER_TYPE_3PH = b'6841131BN243101040'
+
+CORRUPTIONS = (
+    han_kamstrup.INVALID_SIZE,
+    han_kamstrup.INVALID_HEADER_CRC,
+    han_kamstrup.INVALID_FRAME_CRC,
+    han_kamstrup.INVALID_DATA_FLAG,
+    han_kamstrup.INVALID_LENGTH,
+)
+
+# Header after the opening flag: frame format, addresses and control.
+_ADDRESS = bytes([0x41, 0x08, 0x83])
+_INVOKE_ID = b'\x00\x00\x00\x00'
+_DATE_TIME = struct.Struct('>HBBBBBBBhB')
+_UINT32 = struct.Struct('>BI')
+_UINT16 = struct.Struct('>BH')
+_CRC = struct.Struct('<H')
+
+
+def _obis(code):
+    """Encode an OBIS code as an octet-string."""
+    return bytes([0x09, 0x06]) + bytes(code)
+
+
+def _visible_string(text):
+    """Encode a visible-string."""
+    return bytes([0x0A, len(text)]) + text
+
+
+def _date_time(when):
+    """Encode a datetime as a 12 byte COSEM date-time."""
+    return _DATE_TIME.pack(when.year, when.month, when.day,
+                           when.isoweekday(), when.hour, when.minute,
+                           when.second, 0xFF, -60, 0)
+
+
+def random_values(list_type, rng=random):
+    """Return random but plausible values for a list type."""
+    values = {
+        'active_power_p': rng.randrange(0, 20000),
+        'active_power_n': rng.randrange(0, 5000),
+        'reactive_power_p': rng.randrange(0, 5000),
+        'reactive_power_n': rng.randrange(0, 5000),
+        'current_l1': rng.randrange(0, 6300),
+        'voltage_l1': rng.randrange(215, 245),
+    }
+    if list_type in THREE_PHASE:
+        values.update({
+            'current_l2': rng.randrange(0, 6300),
+            'current_l3': rng.randrange(0, 6300),
+            'voltage_l2': rng.randrange(215, 245),
+            'voltage_l3': rng.randrange(215, 245),
+        })
+    if list_type in LONG_LIST:
+        values.update({
+            'active_energy_p': rng.randrange(0, 10 ** 8),
+            'active_energy_n': rng.randrange(0, 10 ** 7),
+            'reactive_energy_p': rng.randrange(0, 10 ** 7),
+            'reactive_energy_n': rng.randrange(0, 10 ** 7),
+        })
+    return values
+
+
+def build_frame(list_type, values, when=None,
+                meter_serial=b'5706567274389702'):
+    """Build a valid frame of list_type.
+
+    values holds the raw integer of each measurement, as in the frame:
+    currents and energies are in 1/100 units.
+    """
+    # pylint: disable=too-many-locals
+    if when is None:
+        when = datetime.datetime.now().replace(microsecond=0)
+    three_phase = list_type in THREE_PHASE
+    meter_type = METER_TYPE_3PH if three_phase else METER_TYPE_1PH
+
+    body = [bytes(han_kamstrup.DATA_FLAG), _INVOKE_ID,
+            b'\x0c', _date_time(when),
+            bytes([0x02, list_type]),
+            _visible_string(LIST_VERSION),
+            _obis((1, 1, 0, 0, 5, 255)), _visible_string(meter_serial),
+            _obis((1, 1, 96, 1, 1, 255)), _visible_string(meter_type)]
+    for code, name in ((1, 'active_power_p'), (2, 'active_power_n'),
+                       (3, 'reactive_power_p'), (4, 'reactive_power_n'),
+                       (31, 'current_l1')):
+        body += [_obis((1, 1, code, 7, 0, 255)),
+                 _UINT32.pack(0x06, values[name])]
+    if three_phase:
+        for code, name in ((51, 'current_l2'), (71, 'current_l3')):
+            body += [_obis((1, 1, code, 7, 0, 255)),
+                     _UINT32.pack(0x06, values[name])]
+        voltages = ((32, 'voltage_l1'), (52, 'voltage_l2'),
+                    (72, 'voltage_l3'))
+    else:
+        voltages = ((32, 'voltage_l1'),)
+    for code, name in voltages:
+        body += [_obis((1, 1, code, 7, 0, 255)),
+                 _UINT16.pack(0x12, values[name])]
+    if list_type in LONG_LIST:
+        body += [_obis((0, 1, 1, 0, 0, 255)),
+                 b'\x09\x0c', _date_time(when.replace(minute=0, second=0))]
+        for code, name in ((1, 'active_energy_p'), (2, 'active_energy_n'),
+                           (3, 'reactive_energy_p'),
+                           (4, 'reactive_energy_n')):
+            body += [_obis((1, 1, code, 8, 0, 255)),
+                     _UINT32.pack(0x06, values[name])]
+    body = b''.join(body)
+
+    # Frame format, addresses, control, HCS, body and FCS.
+    length = 5 + _CRC.size + len(body) + _CRC.size
+    header = bytes([0xA0 | length >> 8, length & 0xFF]) + _ADDRESS
+    frame = header + _CRC.pack(han_crc.crc_x25(header)) + body
+    return b'\x7e' + frame + _CRC.pack(han_crc.crc_x25(frame)) + b'\x7e'
+
+
+def random_frame(list_type=None, rng=random, when=None):
+    """Build a valid frame with random values, of a random list type."""
+    if list_type is None:
+        list_type = rng.choice(LIST_TYPES)
+    return build_frame(list_type, random_values(list_type, rng), when)
+
+
+def corrupt(frame, reason, rng=random):
+    """Return a copy of frame that check_frame rejects for reason."""
+    data = bytearray(frame)
+    if reason == han_kamstrup.INVALID_SIZE:
+        return bytes(data[:rng.randrange(20, 170)])
+    if reason == han_kamstrup.INVALID_HEADER_CRC:
+        data[6] ^= 1 << rng.randrange(8)
+        return bytes(data)
+    if reason == han_kamstrup.INVALID_FRAME_CRC:
+        data[rng.randrange(12, len(data) - 3)] ^= 1 << rng.randrange(8)
+        return bytes(data)
+    if reason == han_kamstrup.INVALID_DATA_FLAG:
+        data[8] ^= 0xFF
+    elif reason == han_kamstrup.INVALID_LENGTH:
+        # A valid frame with a frame format length two bytes short.
+        length = ((data[1] & 0x0F) << 8 | data[2]) - 2
+        data[1:3] = bytes([0xA0 | length >> 8, length & 0xFF])
+        data[6:8] = _CRC.pack(han_crc.crc_x25(data[1:6]))
+    else:
+        raise ValueError('Unknown corruption %s' % reason)
+    data[-3:-1] = _CRC.pack(han_crc.crc_x25(data[1:-3]))
+    return bytes(data)
+
+
+def stream(frames, rng=random, noise=0.0):
+    """Join frames into one byte stream as a meter would send them.
+
+    With noise, random bytes are put between frames with that probability.
+    """
+    chunks = []
+    for frame in frames:
+        if noise and rng.random() < noise:
+            chunks.append(bytes(rng.randrange(256)
+                                for _ in range(rng.randrange(1, 32))))
+        chunks.append(frame)
+    return b''.join(chunks)